@@ -1,4 +1,4 @@
-from twisted.words.xish.domish import Element
+from twisted.words.xish.domish import Element, SerializedXML
 
 from twilix.base.exceptions import ElementParseError, WrongElement
 
@@ -24,6 +24,46 @@ class BreakStanza(object):
     """Stanza that breaks handling loop."""
     pass
 
+class ChildrenList(list):
+    """
+    List of children of MyElement counting its changes.
+
+    Attributes:
+        version -- bumped on every change of the list
+
+        resets -- bumped on every change except appending
+    """
+    version = 0
+    resets = 0
+
+def _counted(name, appending=False):
+    method = getattr(list, name)
+    def counted(self, *args):
+        self.version += 1
+        if not appending:
+            self.resets += 1
+        return method(self, *args)
+    counted.__name__ = name
+    return counted
+
+for _name in ('append', 'extend', '__iadd__'):
+    setattr(ChildrenList, _name, _counted(_name, appending=True))
+for _name in ('insert', 'remove', 'pop', 'sort', 'reverse', '__imul__',
+              '__setitem__', '__delitem__', '__setslice__', '__delslice__'):
+    setattr(ChildrenList, _name, _counted(_name))
+del _name
+
+def get_child_elements(el, name=None, uri=None):
+    """
+    Return list of child elements of el with given name and uri (None means
+    any name or uri). Uses children index of MyElement instances and
+    filters children of other elements.
+    """
+    if isinstance(el, MyElement):
+        return el.getChildElements(name, uri)
+    return [c for c in el.children if not isinstance(c, (str, unicode)) and \
+            (name is None or c.name == name) and (uri is None or c.uri == uri)]
+
 class MyElement(Element):
     """
     Extend class Element from twisted.words.xish.domish.
@@ -38,6 +78,8 @@ class MyElement(Element):
     
     attributesProps = {}
     nodesProps = {}
+    _childrenVersion = 0
+    _frozen = False
 
     def __init__(self, *args, **kwargs):
         super(MyElement, self).__init__(*args, **kwargs)
@@ -75,6 +117,9 @@ class MyElement(Element):
     def createFromElement(cls, el, **kwargs):
         """
         Make class instance of element if it's suits to class.
+        Element el is not copied: instance shares it's children.
+        If el was made by createFromElement too then already decoded
+        attribute values are reused.
                 
         :returns: class instance with host and kwargs of element
         
@@ -109,8 +154,19 @@ class MyElement(Element):
             raise WrongElement
         if cls.elementName is not None and el.name != cls.elementName:
             raise WrongElement
-        for name, attr in cls.attributesProps.items():
-            kwargs[name] = attr.to_python(el.attributes.get(attr.xmlattr, None))
+        if getattr(cls, 'lazyParse', False):
+            return cls(host=host, source=el, **kwargs)
+        parsed = None
+        if isinstance(el, MyElement):
+            parsed = el.__dict__.get('_parsed')
+        attributes = cls.attributesProps.items()
+        for name, attr in attributes:
+            value = el.attributes.get(attr.xmlattr, None)
+            cached = parsed and parsed.get(attr)
+            if cached and cached[0] is value:
+                kwargs[name] = cached[1]
+            else:
+                kwargs[name] = attr.to_python(value)
         for name, attr in cls.nodesProps.items():
             els = attr.get_from_el(el)
             if not isinstance(els, tuple):
@@ -118,7 +174,10 @@ class MyElement(Element):
             else:
                 kwargs[name] = [attr.to_python(e) for e in els]
         r = cls(host=host, **kwargs)
-        r.children = el.children
+        r._shareChildren(el)
+        parsed = r._getParsed()
+        for name, attr in attributes:
+            parsed[attr] = (r.attributes.get(attr.xmlattr), kwargs[name])
         return r
 
     @classmethod
@@ -140,9 +199,9 @@ class MyElement(Element):
     def validate(self):
         """Validate all attributes."""
         for name, attr in self.__class__.attributesProps.items():
-            value = self.__getattr__(name, validate=True)
+            value = self._getField(name, validate=True)
         for name, attr in self.__class__.nodesProps.items():
-            value = self.__getattr__(name, validate=True)
+            value = self._getField(name, validate=True)
             validate = getattr(value, 'validate', None)
             if validate is not None:
                 validate()
@@ -178,8 +237,7 @@ class MyElement(Element):
         attr = self.attributesProps.get(name, None)
         node = self.nodesProps.get(name, None)
         if attr and not need_adder:
-            return self._validate(name, attr, attr.get_from_el(self), 
-                                    validate=validate)
+            return self._getField(name, validate=validate)
         elif node:
             if need_adder and node.listed:
                 def adder(value):
@@ -221,21 +279,83 @@ class MyElement(Element):
 
             elif (need_adder or need_remover):
                 return
-            if node.listed:
-                listed_name = '%s_listed' % name
-                return self._fvalidate(listed_name,
-                        [self._validate(name, node, v, validate=validate) \
-                        for v in node.get_from_el(self)])
-            else:
-                return self._validate(name, node, node.get_from_el(self),
-                                      validate=validate)
+            return self._getField(name, validate=validate)
         elif not name.startswith('clean_'):
             return super(MyElement, self).__getattr__(name)
 
+    def _getParsed(self):
+        """
+        Return dict of decoded field values with format :
+
+            key is a field (attribute or node property)
+
+            value is a (token, value)-style tuple where token is a raw
+            attribute value or a children state value was decoded from
+        """
+        parsed = self.__dict__.get('_parsed')
+        if parsed is None:
+            parsed = self.__dict__['_parsed'] = {}
+        return parsed
+
+    def _getField(self, name, validate=False):
+        """
+        Return valid value of attribute or node field with name.
+        Attribute value is decoded with to_python only once: it's cached
+        until attribute is changed. Value of cacheable node (see
+        NodeProp.cacheable) is cached until children or state of found
+        nodes are changed, other nodes are decoded on every access.
+        Cleaning functions are called on every access.
+        """
+        parsed = self._getParsed()
+        attr = self.attributesProps.get(name, None)
+        if attr is not None:
+            raw = attr.get_from_el(self)
+            cached = parsed.get(attr)
+            if cached is not None and cached[0] is raw:
+                value = cached[1]
+            else:
+                value = attr.to_python(raw)
+                parsed[attr] = (raw, value)
+            return self._cleanField(name, attr, value, validate)
+        node = self.nodesProps[name]
+        raw = node.get_from_el(self)
+        cached = None
+        if node.cacheable:
+            token = (self._childrenToken(), node.get_state(raw))
+            cached = parsed.get(node)
+        if cached is not None and cached[0] == token:
+            value = cached[1]
+        else:
+            if node.listed:
+                value = [node.to_python(v) for v in raw]
+            else:
+                value = node.to_python(raw)
+            if node.cacheable:
+                # decoding may replace children lists of found nodes
+                parsed[node] = ((self._childrenToken(), node.get_state(raw)),
+                                value)
+        if node.listed:
+            return self._fvalidate('%s_listed' % name,
+                    [self._cleanField(name, node, v, validate) for v in value])
+        return self._cleanField(name, node, value, validate)
+
+    def _cleanField(self, name, attr, value, validate=False):
+        """Call cleaning functions to already decoded value of field."""
+        if validate:
+            value = attr.clean(value)
+        return self._fvalidate(name, value)
+
     def _fvalidate(self, name, value):
-        nvalidator = getattr(self, 'clean_%s' % name, None)
+        cls = self.__class__
+        cleaners = cls.__dict__.get('_cleaners')
+        if cleaners is None:
+            cleaners = cls._cleaners = {}
+        try:
+            nvalidator = cleaners[name]
+        except KeyError:
+            nvalidator = cleaners[name] = getattr(cls, 'clean_%s' % name, None)
         if nvalidator is not None:
-            value = nvalidator(value)
+            value = nvalidator(self, value)
         return value
 
     def _validate(self, name, attr, value, setter=False, validate=False):
@@ -278,6 +398,8 @@ class MyElement(Element):
         """
         attr = self.attributesProps.get(name, None)
         node = self.nodesProps.get(name, None)
+        if attr or node:
+            self._getParsed().pop(attr or node, None)
         if attr:
             value = self._validate(name, attr, value, setter=True)
             self.cleanAttribute(attr.xmlattr)
@@ -306,8 +428,77 @@ class MyElement(Element):
                     n.addChild(unicode(content))
                     self.addChild(n)
         else:
+            if name == 'children':
+                self.__dict__['_childrenVersion'] = self._childrenVersion + 1
+                if isinstance(value, list) and \
+                   not isinstance(value, ChildrenList):
+                    value = ChildrenList(value)
             super(MyElement, self).__setattr__(name, value)
 
+    def __getstate__(self):
+        """Don't copy decoded values cache and children index with the
+        element."""
+        state = self.__dict__.copy()
+        state.pop('_parsed', None)
+        state.pop('_index', None)
+        return state
+
+    def freeze(self):
+        """
+        Mark element as frozen: it's serialized XML is cached and reused
+        every time the element (or the element it's linked to) is sent.
+        Cache is dropped when attributes or children of the element are
+        changed. Changes made deeper in the subtree are not tracked, call
+        unfreeze and freeze again after such changes.
+
+        :returns: self
+        """
+        self._frozen = True
+        return self
+
+    def unfreeze(self):
+        """Drop serialized XML cache and stop caching."""
+        self._frozen = False
+        self.__dict__.pop('_serialized', None)
+
+    def getSerialized(self):
+        """
+        Return element serialized to XML as SerializedXML which can be added
+        to another element as a child. Result is cached for frozen element.
+        """
+        token = (self._childrenToken(), tuple(self.attributes.items()))
+        cached = self.__dict__.get('_serialized')
+        if cached is not None and cached[0] == token:
+            return cached[1]
+        xml = SerializedXML(self._toXml())
+        if self._frozen:
+            self.__dict__['_serialized'] = (token, xml)
+        return xml
+
+    def toXml(self, *args, **kwargs):
+        """
+        Overrides toXml method of Element.
+        Serialized XML of frozen element and frozen children is taken from
+        cache (see freeze method).
+        """
+        if self._frozen and not args and not kwargs:
+            return self.getSerialized()
+        return self._toXml(*args, **kwargs)
+
+    def _toXml(self, *args, **kwargs):
+        children = self.children
+        for c in children:
+            if isinstance(c, MyElement) and c._frozen:
+                break
+        else:
+            return super(MyElement, self).toXml(*args, **kwargs)
+        envelope = Element((self.uri, self.name), self.defaultUri,
+                           self.attributes, self.localPrefixes)
+        envelope.children = [c.getSerialized() \
+                             if isinstance(c, MyElement) and c._frozen else c \
+                             for c in children]
+        return envelope.toXml(*args, **kwargs)
+
     def topElement(self):
         """
         Return top element in elements hierarchy.
@@ -333,12 +524,10 @@ class MyElement(Element):
         :raises: ValueError
         
         """
-        r = u''
         for c in self.children:
             if not isinstance(c, (unicode, str)):
                 raise ValueError
-            r += c
-        return r
+        return u''.join(self.children)
 
     def _content_set(self, value):
         """
@@ -378,6 +567,57 @@ class MyElement(Element):
         if self.hasAttribute(attrib):
             del self.attributes[attrib]
 
+    def _childrenToken(self):
+        """
+        Return value which is changed every time children list is
+        reassigned or changed.
+        """
+        return (self._childrenVersion, self.children.version)
+
+    def _shareChildren(self, el):
+        """
+        Take children list of el as is. Plain list of el is replaced with
+        ChildrenList so changes made by both elements are counted.
+        """
+        self.children = el.children
+        if el.children is not self.children:
+            el.children = self.children
+
+    def getChildElements(self, name=None, uri=None):
+        """
+        Return list of child elements with given name and uri (None means
+        any name or uri). Returned list must not be changed.
+
+        Lookup uses an index of children by name and uri. Index is built on
+        first lookup, updated when children are appended and rebuilt when
+        children list is reassigned or changed otherwise (e.g. by
+        removeChilds or insert).
+        """
+        children = self.children
+        version = (self._childrenVersion, children.resets)
+        index = self.__dict__.get('_index')
+        if index is None or index[0] != version or index[1] > len(children):
+            index = (version, 0, {})
+        version, count, elements = index
+        if count < len(children):
+            for i in xrange(count, len(children)):
+                c = children[i]
+                if isinstance(c, (str, unicode)):
+                    continue
+                for key in (None, c.name, (c.name, c.uri), (None, c.uri)):
+                    try:
+                        elements[key].append(c)
+                    except KeyError:
+                        elements[key] = [c]
+            self.__dict__['_index'] = (version, len(children), elements)
+        if isinstance(uri, list):
+            uri = tuple(uri)
+        if uri is None:
+            key = name
+        else:
+            key = (name, uri)
+        return elements.get(key, ())
+
     def removeChilds(self, name=None, uri=None, element=None):
         """
         Remove all content and child elements appropriate 
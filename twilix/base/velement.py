@@ -33,15 +33,36 @@ property since it is a predefined keyword" % (field_name,)
             node_fields = base.nodesProps.items() + node_fields
     return dict(attr_fields), dict(node_fields)
 
+class FieldDescriptor(object):
+    """
+    Data descriptor installed by DeclarativeFieldsMetaClass for every
+    declared field. Gives access to the field value without going through
+    __getattr__.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance._getField(self.name)
+
+    def __set__(self, instance, value):
+        instance.__setattr__(self.name, value)
+
 class DeclarativeFieldsMetaClass(type):
     """
     Metaclass for VElement.
     Set get_declared_fields as getter for fields 'attributesProps' and
-    'nodesProps'.
+    'nodesProps'. Install FieldDescriptor for every field declared in class.
     """
     def __new__(cls, name, bases, attrs):
+        declared = [field_name for field_name, obj in attrs.items() \
+                    if isinstance(obj, (fields.AttributeProp, fields.NodeProp))]
         attrs['attributesProps'], attrs['nodesProps'] = \
               get_declared_fields(bases, attrs)
+        for field_name in declared:
+            attrs[field_name] = FieldDescriptor(field_name)
 
         _descriptors = attrs.get('_descriptors')
         if not _descriptors:
@@ -68,6 +89,10 @@ class VElement(MyElement):
     elementUri which is an XML namespace (could be a string or a iterable of
     strings which means that any of that namespaces are valid for this element)
     and based on it's attributes and nodes that declared by using fields.
+
+    If lazyParse is True then createFromElement doesn't decode any field:
+    instance takes attributes and children of the parsed element as is and
+    every field is decoded on the first access.
     """
     elementName = None
     elementUri = None
@@ -85,6 +110,7 @@ class VElement(MyElement):
     result_class = None
     error_class = None
     isRequired = True
+    lazyParse = False
     dispatcher = None
     _descriptors = ('result_class', 'error_class', 'dispatcher')
 
@@ -96,13 +122,24 @@ class VElement(MyElement):
         
         For example::
             iq = Iq(type_='set', from_='me')
+
+        Element passed as source is used to take attributes and children
+        from without decoding them.
         """
         uri = kwargs.get('uri', None)
         name = kwargs.get('el_name', self.elementName)
+        source = kwargs.get('source', None)
         if uri is None and isinstance(self.elementUri, (str, unicode)):
             uri = self.elementUri
         super(VElement, self).__init__((uri, name),
                                        localPrefixes=self.elementPrefixes)
+        if source is not None:
+            self.attributes = dict(source.attributes)
+            self._shareChildren(source)
+            if isinstance(source, MyElement):
+                parsed = source._getParsed()
+                self._getParsed().update((attr, parsed[attr]) \
+                    for attr in self.attributesProps.values() if attr in parsed)
         self.host = kwargs.get('host', None)
         self.parent = kwargs.get('parent', None)
         try:
@@ -121,6 +158,8 @@ class VElement(MyElement):
             value = kwargs.get(attr, None)
             if value is not None:
                 setattr(self, attr, value)
+        if source is not None:
+            return
         for attr, node in self.nodesProps.items():
             value = kwargs.get(attr, None)
             if value is not None or node.default is not None:
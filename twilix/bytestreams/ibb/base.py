@@ -1,10 +1,14 @@
 import base64
+import binascii
 import hashlib
+import os
+import string
 import time
+from collections import deque
 
 from twisted.internet import defer, reactor
 
-from twilix.bytestreams import genSID
+from twilix.bytestreams import genSID, stats as stats_
 from twilix.bytestreams.ibb import IBB_NS
 from twilix.bytestreams.ibb.stanzas import OpenQuery, CloseQuery as CQ,\
                                             DataQuery as DQ,\
@@ -31,6 +35,7 @@ class InitiationQuery(OpenQuery, PersonsValidator):
         self.host.sessions[self.sid]['active'] = True
         if self.stanza == 'message':
             self.host.session[self.sid]['stanza'] = 'message'
+        self.host.sessions[self.sid]['transport'].start()
         return self.iq.makeResult()
 
 class CloseQuery(CQ, PersonsValidator):
@@ -43,25 +48,64 @@ class CloseQuery(CQ, PersonsValidator):
         return self.iq.makeResult()
 
 class DataHandler(object):
+    def decode(self, block_size):
+        """
+        Decode base64 text nodes one by one without joining them.
+
+        :returns: list of decoded strings.
+
+        :raises: NotAcceptableException, BadRequestException
+
+        """
+        pieces = []
+        rest = ''
+        length = 0
+        try:
+            for c in self.children:
+                if not isinstance(c, (unicode, str)):
+                    raise errors.BadRequestException
+                c = str(c).translate(None, string.whitespace)
+                length += len(c)
+                if length > block_size * 2:
+                    raise errors.NotAcceptableException
+                c = rest + c
+                end = len(c) - len(c) % 4
+                rest = c[end:]
+                if end:
+                    pieces.append(binascii.a2b_base64(c[:end]))
+        except (UnicodeError, binascii.Error):
+            raise errors.BadRequestException
+        if rest:
+            raise errors.BadRequestException
+        return pieces
+
     def handler(self):
         if self.sid not in self.host.sessions or \
             not self.host.sessions[self.sid]['active']:
             raise errors.ItemNotFoundException
         self.validate_persons()
         s = self.host.sessions[self.sid]
-        c = self.content.strip()
-        if len(c) > s['block_size'] * 2: 
+        pieces = self.decode(s['block_size'])
+        size = sum(len(p) for p in pieces)
+        if size > s['block_size']:
             raise errors.NotAcceptableException
         if self.seq != s['incoming_seq']:
             raise errors.UnexpectedRequestException
         s['incoming_seq'] += 1
         s['incoming_seq'] = s['incoming_seq'] % 65536
-        try:
-            buf = base64.b64decode(c)
-        except TypeError:
-            raise errors.BadRequestException
-        if len(buf) > s['block_size']:
-            raise errors.NotAcceptableException
+        if not s['view']:
+            buf = pieces[0] if len(pieces) == 1 else ''.join(pieces)
+        elif len(pieces) == 1:
+            buf = memoryview(pieces[0])
+        else:
+            # Join pieces in the session's reusable buffer
+            if s['buffer'] is None:
+                s['buffer'] = bytearray(s['block_size'])
+            pos = 0
+            for p in pieces:
+                s['buffer'][pos:pos + len(p)] = p
+                pos += len(p)
+            buf = memoryview(s['buffer'])[:size]
         self.host.dataReceived(self.sid, buf)
         iq = self.iq
         if iq:
@@ -78,64 +122,236 @@ class DataMessage(DataHandler, MDQ, PersonsValidator):
             return self.handler()
 
 class Transport(object):
-    def __init__(self, sid, session, dispatcher, interval):
+    """
+    Sends written data to the session's peer as a sequence of data IQs.
+
+    Up to window data IQs are sent without waiting for their results. Next
+    blocks are sent as soon as results arrive, so there is no polling. The
+    window grows while round trip time stays close to the minimal one and
+    shrinks when it grows (i.e. when data is queued somewhere on the way).
+    If session doesn't wait for results all buffered data is sent at once.
+
+    Written data is kept as a queue of chunks and blocks are cut from it
+    without copying the rest of the buffer. A streaming producer is paused
+    when more than high_water bytes are buffered and resumed when buffer
+    goes below low_water.
+
+    :param interval: minimal interval between two blocks in seconds.
+
+    :param window: initial number of data IQs in flight.
+
+    :param clock: reactor to use (for testing).
+    """
+    min_window = 1
+    max_window = 32
+    high_water = 2 ** 18
+    low_water = 2 ** 16
+
+    def __init__(self, sid, session, dispatcher, interval=0, window=4,
+                 clock=None):
         self.session = session
         self.dispatcher = dispatcher
         self.sid = sid
         self.producer = None
+        self.streaming = False
+        self.paused = False
         self.interval = interval
-        self.buf = ''
-        self._produce()
-        
+        self.window = window
+        self.clock = clock or reactor
+        self.chunks = deque()
+        self.offset = 0
+        self.buffered = 0
+        self.inflight = 0
+        self.rtt = None
+        self.min_rtt = None
+        self._next_send = 0
+        self._pump_call = None
+        self._resume_call = None
+        self._drained = []
+
     def write(self, buf):
-        self.buf += buf
+        if not buf:
+            return
+        self.chunks.append(buf)
+        self.buffered += len(buf)
+        if self.streaming and not self.paused and \
+           self.buffered > self.high_water:
+            self.paused = True
+            self.producer.pauseProducing()
+        self._pump()
+
+    def _read(self, size):
+        """Remove at most size bytes from the buffer and return them."""
+        parts = []
+        while size and self.chunks:
+            chunk = self.chunks[0]
+            end = self.offset + size
+            if end < len(chunk):
+                parts.append(chunk[self.offset:end])
+                self.offset = end
+                break
+            parts.append(chunk[self.offset:] if self.offset else chunk)
+            size -= len(chunk) - self.offset
+            self.chunks.popleft()
+            self.offset = 0
+        data = ''.join(parts) if len(parts) != 1 else parts[0]
+        self.buffered -= len(data)
+        return data
+
+    def _clear(self):
+        self.chunks.clear()
+        self.offset = 0
+        self.buffered = 0
+
+    @property
+    def block_size(self):
+        return self.session['block_size']
+
+    def start(self):
+        """Start sending when session becomes active."""
+        self._pump()
+
+    def stop(self):
+        """Stop sending and forget the producer."""
+        self.unregisterProducer()
+        for call in (self._pump_call, self._resume_call):
+            if call is not None and call.active():
+                call.cancel()
+        self._pump_call = self._resume_call = None
+
+    def whenSent(self):
+        """
+        :returns: deferred fired when all written data has been sent or
+        failed if sending failed.
+        """
+        if not self.buffered:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._drained.append(d)
+        return d
 
-    @defer.inlineCallbacks
     def _write(self):
         # XXX: Error handling
-        if not self.session['active']:
-            defer.returnValue(None)
-        toSend = self.buf[:self.session['block_size']]
-        self.buf = self.buf[self.session['block_size']:]
-        toSend = base64.b64encode(toSend)
+        data = self._read(self.session['block_size'])
+        self.session['stats'].sent(len(data))
+        toSend = base64.b64encode(data)
         dq = DQ(seq=self.session['outgoing_seq'],
                 sid=self.sid,
                 parent=Iq(to=self.session['initiator'],
                           from_=self.session['target'],
                           type_='set'))
         self.session['outgoing_seq'] += 1
+        self.session['outgoing_seq'] %= 65536
         if self.session['is_outgoing']:
             dq.iq.swapAttributeValues('to', 'from')
         dq.content = toSend
-        if self.session['wait_for_result_when_send']:
-            yield self.dispatcher.send(dq.iq)
+        d = self.dispatcher.send(dq.iq)
+        if self.session['wait_for_result_when_send'] and d is not None:
+            self.inflight += 1
+            d.addCallbacks(self._sent, self._failed,
+                           callbackArgs=(self.clock.seconds(),))
+
+    def _sent(self, result, sent_at):
+        self.inflight -= 1
+        self._adaptWindow(self.clock.seconds() - sent_at)
+        self._pump()
+
+    def _failed(self, failure):
+        self.inflight -= 1
+        self._clear()
+        if self.producer is not None:
+            self.producer.stopProducing()
+        self.stop()
+        self._fireDrained(failure)
+
+    def _adaptWindow(self, rtt):
+        """Change window size according to measured round trip time."""
+        if self.min_rtt is None or rtt < self.min_rtt:
+            self.min_rtt = rtt
+        if self.rtt is None:
+            self.rtt = rtt
         else:
-            self.dispatcher.send(dq.iq)
+            self.rtt = 0.875 * self.rtt + 0.125 * rtt
+        if self.rtt <= self.min_rtt * 1.5:
+            self.window = min(self.window + 1, self.max_window)
+        elif self.rtt > self.min_rtt * 3:
+            self.window = max(self.window - 1, self.min_window)
 
-    def registerProducer(self, producer, streaming):
-        assert streaming == False
-        self.producer = producer
-        self._produce()
-    
-    def _produce(self):
-        if self.buf:
+    def _schedule(self, call, delay, func):
+        """Return call if it's still pending or schedule a new one."""
+        if call is not None and call.active():
+            return call
+        return self.clock.callLater(delay, func)
+
+    def _pump(self):
+        """Send as many blocks as window allows."""
+        if not self.session['active']:
+            return
+        while self.buffered and self.inflight < self.window:
+            if self.interval:
+                now = self.clock.seconds()
+                if now < self._next_send:
+                    self._pump_call = self._schedule(self._pump_call,
+                                        self._next_send - now, self._pump)
+                    return
+                self._next_send = now + self.interval
             self._write()
-        elif self.producer:
+        if self.paused and self.buffered < self.low_water:
+            self.paused = False
             self.producer.resumeProducing()
-        reactor.callLater(self.interval, self._produce)
+        if not self.buffered:
+            self._fireDrained()
+            if self.producer is not None and not self.streaming:
+                # Pull next data on the next reactor iteration
+                self._resume_call = self._schedule(self._resume_call, 0,
+                                                   self._resumeProducer)
+
+    def _resumeProducer(self):
+        if self.producer is not None and not self.buffered:
+            self.producer.resumeProducing()
+
+    def _fireDrained(self, failure=None):
+        drained, self._drained = self._drained, []
+        for d in drained:
+            if failure is None:
+                d.callback(None)
+            else:
+                d.errback(failure)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streaming = streaming
+        self.paused = False
+        self._pump()
 
     def unregisterProducer(self):
         self.producer = None
+        self.streaming = False
+        self.paused = False
 
 class IbbStream(object):
     """ Describe a in-band bytestream service which allow you
-        to pass binary data through an XML-stream. """
+        to pass binary data through an XML-stream.
+
+        :param send_interval: minimal interval between data blocks.
+
+        :param window: initial number of data IQs sent without waiting
+        for results (see Transport).
+
+        :param stats: StatsRegistry to count transfers in (default
+        registry of twilix.bytestreams.stats is used if it's not given).
+
+        :param clock: reactor to use (for testing). """
     NS = IBB_NS
 
-    def __init__(self, dispatcher, send_interval=1):
+    def __init__(self, dispatcher, send_interval=0, window=4, stats=None,
+                 clock=None):
         self.dispatcher = dispatcher
         self.sessions = {}
         self.send_interval = send_interval
+        self.window = window
+        self.stats = stats or stats_.registry
+        self.clock = clock
         
     def init(self, disco=None):
         if disco is not None:
@@ -148,6 +364,12 @@ class IbbStream(object):
 
     def dataReceived(self, sid, buf, dont_unregister=False):
         session = self.sessions[sid]
+        if buf is not None:
+            session['stats'].received(len(buf))
+            if session['fd'] is not None:
+                written = os.write(session['fd'], buf)
+                while written < len(buf):
+                    written += os.write(session['fd'], buf[written:])
         session['callback'](buf, session['meta'])
         if buf is None and not dont_unregister:
             self.unregisterSession(sid=sid)
@@ -167,9 +389,14 @@ class IbbStream(object):
 
     def registerSession(self, sid, initiator, target, callback, meta=None,
                         block_size=None, stanza_type='iq',
-                        wait_for_result_when_send=True):
+                        wait_for_result_when_send=True, fd=None, view=False):
         """
         Register bytestream session to wait for incoming connection.
+
+        :param fd: file descriptor to write received data to.
+
+        :param view: pass received data to callback as memoryview instead
+        of string. The memoryview is valid only until callback returns.
         """
         if isinstance(initiator, (str, unicode)):
             initiator = internJID(initiator)
@@ -188,15 +415,30 @@ class IbbStream(object):
             'wait_for_result_when_send': wait_for_result_when_send,
             'is_outgoing': False,
             'stanza': 'iq',
+            'fd': fd,
+            'view': view,
+            'buffer': None,
+            'stats': self.stats.start(sid, 'ibb'),
         }
         meta['transport'] = Transport(sid, meta, self.dispatcher,
-                                      self.send_interval)
+                                      self.send_interval, self.window,
+                                      self.clock)
         self.sessions[sid] = meta
         return meta
 
     def unregisterConnection(self, sid):
         s = self.sessions[sid]
         if not s['active']:
+            # Session never became active (e.g. it timed out), there is
+            # no connection to close
+            self.stats.finish(sid)
+            return
+        if s['is_outgoing'] and s['transport'].buffered:
+            # Close the stream when all written data is sent
+            d = s['transport'].whenSent()
+            # Close the stream even if sending failed
+            d.addBoth(lambda _: sid in self.sessions and \
+                                self.unregisterConnection(sid))
             return
         self.dataReceived(sid, None, dont_unregister=True)
         self._unregisterConnection(sid)
@@ -209,9 +451,10 @@ class IbbStream(object):
                           type_='set'))
         if s['is_outgoing']:
             cq.iq.swapAttributeValues('to', 'from')
-        self.getTransport(sid).unregisterProducer()
+        self.getTransport(sid).stop()
         s['active'] = False
         del self.sessions[sid]
+        self.stats.finish(sid)
         return self.dispatcher.send(cq.iq)
 
     def unregisterSession(self, sid):
@@ -260,4 +503,5 @@ class IbbStream(object):
             raise
         
         s['active'] = True
+        s['transport'].start()
         defer.returnValue(sid)
@@ -3,14 +3,16 @@ import time
 import hashlib
 import random
 import warnings
+from collections import OrderedDict
 
 from twisted.internet import protocol, reactor, defer, error
+from twisted.python.failure import Failure
 
 from twilix.disco import Feature
 from twilix.stanzas import Iq
 from twilix import errors
 
-from twilix.bytestreams import genSID
+from twilix.bytestreams import genSID, stats as stats_
 from twilix.bytestreams.socks5 import SOCKS5_NS
 from twilix.bytestreams.socks5 import stanzas
 from twilix.bytestreams.socks5.proxy65 import XEP65Proxy
@@ -35,16 +37,24 @@ class Socks5ClientFactory(protocol.ClientFactory):
     def clientConnectionLost(self, connector, reason):
         if self.protocol.state == STATE_READY:
             self.host.dataReceived(self.addr, None)
-        else:
+        elif not self.deferred.called:
             self.deferred.errback('connection lost')
 
     def clientConnectionFailed(self, connector, reason):
-        self.deferred.errback(reason)
-
-def _startClient(host, rhost, port, addr):
-    d = defer.Deferred()
+        if not self.deferred.called:
+            self.deferred.errback(reason)
+
+def _startClient(host, rhost, port, addr, timeout=30):
+    """
+    Connect to a streamhost.
+
+    :returns: deferred fired when SOCKS5 connection is ready. Cancelling
+    the deferred drops the connection attempt.
+    """
+    connectors = []
+    d = defer.Deferred(canceller=lambda _: connectors[0].disconnect())
     f = Socks5ClientFactory(host, addr, d)
-    reactor.connectTCP(rhost, port, f)
+    connectors.append(reactor.connectTCP(rhost, port, f, timeout=timeout))
     return d
 
 class InitiationQuery(stanzas.StreamHostQuery):
@@ -52,84 +62,78 @@ class InitiationQuery(stanzas.StreamHostQuery):
     def setHandler(self):
         if self.sid not in self.host.sessions:
             raise errors.NotAcceptableException
-        deferreds = []
-        time_calls = []
-
-        def _eb(failure, d):
-            """ Errorback for a streamhost candidate """
-            # Remove this deferred from wait list
-            if d is not None:
-                deferreds.remove(d)
-            # If there is no more candidates to check and we still did not
-            # callback then we raise ItemNotFound because we can't connect
-            # to any candidate
-            if not deferreds and not time_calls and not my_defer.called:
-                self.host.sessions[self.sid]['meta']['deferred'].\
-                    errback(errors.ItemNotFoundException())
-                my_defer.errback(errors.ItemNotFoundException())
-                
-        def _cb(result, d, streamhost):
-            """ Callback for a streamhost candidate """
-            # Okay, we've found the candidate, let's generate a reply
+        addr = hashSID(self.sid, self.iq.from_, self.iq.to)
+
+        def _cb(streamhost):
+            """ Okay, we've found the candidate, let's generate a reply """
             used = stanzas.StreamHostUsed(jid=streamhost.jid)
             used_query = stanzas.StreamHostUsedQuery(sid=self.sid,
                                                      streamhost_used=used)
             iq = self.iq.makeResult()
             iq.link(used_query)
-            my_defer.callback(iq)
+            return iq
 
-            # Clean up all ongoing checks
-            for time_call in time_calls:
-                time_call.cancel()
-            for defer in deferreds:
-                defer.cancel()
-        
-        def i():
-            # An iterator which iterates through deferreds to check
-            for streamhost in self.streamhosts:
-                addr = hashSID(self.sid, self.iq.from_, self.iq.to)
-                d = _startClient(self.host, streamhost.rhost,
-                                 streamhost.port, addr)
-                d.addCallback(_cb, d, streamhost)
-                d.addErrback(_eb, d)
-                deferreds.append(d)
-                yield
-
-        def later(iterator, interval=3):
-            """ Call iterators with a given interval """
-            # Remove earliest time call if it exists
-            if time_calls:
-                time_calls.pop(0)
-            # Iterate to a next streamhost
-            try:
-                iterator.next()
-            except StopIteration:
-                # We don't have to test anything now, call errorback to clean
-                _eb(None, None)
-            else:
-                # Call next deferred after the interval
-                _later(iterator, interval)
-        def _later(iterator, interval):
-            time_calls.append(reactor.callLater(5, later, iterator))
-        
-        iterator = i()
-        later(iterator)
+        def _eb(failure):
+            """ We can't connect to any candidate """
+            self.host.sessions[self.sid]['meta']['deferred'].\
+                errback(errors.ItemNotFoundException())
+            return failure
 
-        my_defer = defer.Deferred()
-        return my_defer
+        d = self.host.probeStreamHosts(self.streamhosts, addr)
+        d.addCallbacks(_cb, _eb)
+        return d
 
 class Socks5Stream(protocol.Factory):
     """ Describe a socks5 (XEP-0060) stream service which allow you
         to pass binary data to another entity even if entity is behind
-        firewall or NAT. """
+        firewall or NAT.
+
+        Offered streamhosts are probed concurrently: a new candidate is
+        started every probe_stagger seconds (or at once when a candidate
+        fails) while less than max_probes are in progress. The first
+        connected candidate is used and the other attempts are cancelled.
+        Connect latency of every candidate is kept in latencies and
+        historically fast streamhosts are tried first.
+
+        Proxies of the server are discovered concurrently (up to
+        proxy_concurrency queries at once). proxies is ordered by the
+        response time of the proxy, which is kept in proxy_latencies, so
+        the fastest proxies are offered first.
+
+        :param max_probes: number of candidates connected at once.
+
+        :param probe_stagger: delay before starting next candidate.
+
+        :param probe_timeout: connect timeout for a candidate.
+
+        :param proxy_concurrency: number of proxy discovery queries sent
+        at once.
+
+        :param proxy_timeout: timeout for a proxy discovery query.
+
+        :param stats: StatsRegistry to count transfers in (default
+        registry of twilix.bytestreams.stats is used if it's not given).
+
+        :param clock: reactor to use for delayed calls (for testing). """
     NS = SOCKS5_NS
 
-    def __init__(self, dispatcher):
+    def __init__(self, dispatcher, max_probes=3, probe_stagger=0.25,
+                 probe_timeout=10, proxy_concurrency=5, proxy_timeout=10,
+                 stats=None, clock=None):
         self.dispatcher = dispatcher
         self.sessions = {}
         self.connections = {}
         self.port = None
-        self.proxies = {}
+        self.proxies = OrderedDict()
+        self.proxy_latencies = {}
+        self.proxy_concurrency = proxy_concurrency
+        self.proxy_timeout = proxy_timeout
+        self.max_probes = max_probes
+        self.probe_stagger = probe_stagger
+        self.probe_timeout = probe_timeout
+        self.clock = clock or reactor
+        self.latencies = {}
+        self.stats = stats or stats_.registry
 
     def buildProtocol(self, addr):
         return XEP65Proxy(self)
@@ -181,20 +185,139 @@ class Socks5Stream(protocol.Factory):
             ifaces.append((addr, port))
         return ifaces
 
+    def connectStreamHost(self, streamhost, addr):
+        """
+        Connect to the streamhost.
+
+        :returns: deferred fired when connection is ready.
+        """
+        return _startClient(self, streamhost.rhost, streamhost.port, addr,
+                            self.probe_timeout)
+
+    def sortStreamHosts(self, streamhosts):
+        """
+        Sort streamhosts: connected before by latency, then unknown ones,
+        then ones which failed last time.
+        """
+        def key(streamhost):
+            hostport = (streamhost.rhost, streamhost.port)
+            if hostport not in self.latencies:
+                return (1, 0)
+            latency = self.latencies[hostport]
+            if latency is None:
+                return (2, 0)
+            return (0, latency)
+        return sorted(streamhosts, key=key)
+
+    def probeStreamHosts(self, streamhosts, addr):
+        """
+        Connect to streamhosts concurrently and keep the first connection.
+
+        :returns: deferred fired with the connected streamhost or failed
+        with ItemNotFoundException if there is no reachable streamhost.
+        """
+        result = defer.Deferred()
+        pending = self.sortStreamHosts(streamhosts)
+        attempts = {}
+        calls = []
+
+        def cancelCalls():
+            for call in calls:
+                if call.active():
+                    call.cancel()
+            del calls[:]
+
+        def start():
+            cancelCalls()
+            if result.called or not pending or \
+               len(attempts) >= self.max_probes:
+                return
+            streamhost = pending.pop(0)
+            d = self.connectStreamHost(streamhost, addr)
+            attempts[d] = streamhost
+            d.addCallbacks(connected, failed,
+                           callbackArgs=(d, streamhost, self.clock.seconds()),
+                           errbackArgs=(d, streamhost))
+            if pending and not result.called:
+                calls.append(self.clock.callLater(self.probe_stagger, start))
+
+        def connected(_, d, streamhost, started):
+            del attempts[d]
+            latency = self.clock.seconds() - started
+            self.latencies[(streamhost.rhost, streamhost.port)] = latency
+            if result.called:
+                return
+            result.callback(streamhost)
+            cancelCalls()
+            for other in attempts.keys():
+                other.cancel()
+
+        def failed(failure, d, streamhost):
+            attempts.pop(d, None)
+            if result.called:
+                return
+            self.latencies[(streamhost.rhost, streamhost.port)] = None
+            if pending:
+                start()
+            elif not attempts:
+                result.errback(errors.ItemNotFoundException())
+
+        if not pending:
+            result.errback(errors.ItemNotFoundException())
+        else:
+            start()
+        return result
+
     def getTransport(self, sid):
+        """
+        Return TCP transport of the session. It's a consumer for outgoing
+        data and a push producer of incoming data, so a consumer may
+        register it to pause the socket. Written data is counted in
+        the session's stats.
+        """
         session = self.sessions[sid]
         c = self.connections[session['hash']]['connection']
         if c:
-            return c.transport
+            consumer = session['consumer']
+            if consumer is None or consumer.consumer is not c.transport:
+                consumer = stats_.StatsConsumer(c.transport,
+                                                session['stats'])
+                session['consumer'] = consumer
+            return consumer
 
     def dataReceived(self, addr, buf):
+        """
+        Pass received data to the session's callback. If the callback
+        returns a deferred the socket is paused until it fires.
+        """
         connection = self.connections.get(addr)
         if not connection:
             return
         
-        connection['callback'](buf, self.sessions[connection['sid']]['meta'])
+        session = self.sessions[connection['sid']]
+        if buf is not None:
+            session['stats'].received(len(buf))
+        r = connection['callback'](buf, session['meta'])
         if buf is None:
             self.unregisterSession(addr=addr)
+        elif isinstance(r, defer.Deferred) and not r.called:
+            self._pauseUntil(addr, connection, r)
+
+    def _pauseUntil(self, addr, connection, d):
+        connection['pending'] += 1
+        if connection['pending'] == 1:
+            connection['connection'].transport.pauseProducing()
+
+        def resume(result):
+            connection['pending'] -= 1
+            if self.connections.get(addr) is not connection:
+                return
+            if isinstance(result, Failure):
+                # Consumer failed, abort the transfer
+                self.unregisterSession(addr=addr)
+            elif not connection['pending']:
+                connection['connection'].transport.resumeProducing()
+        d.addBoth(resume)
 
     def dataSend(self, sid, buf):
         t = self.getTransport(sid)
@@ -202,6 +325,21 @@ class Socks5Stream(protocol.Factory):
             t.write(buf)
             return True
 
+    def registerProducer(self, sid, producer, streaming):
+        """
+        Register producer of outgoing data for the session. Producer is
+        paused while socket's send buffer is full.
+        """
+        t = self.getTransport(sid)
+        if t:
+            t.registerProducer(producer, streaming)
+            return True
+
+    def unregisterProducer(self, sid):
+        t = self.getTransport(sid)
+        if t:
+            t.unregisterProducer()
+
     def isActive(self, sid):
         session = self.connections[self.sessions[sid]['hash']]
         return session['connection']
@@ -214,11 +352,14 @@ class Socks5Stream(protocol.Factory):
         meta = {
             'meta': meta,
             'hash': hashSID(sid, initiator, target),
+            'stats': self.stats.start(sid, 'socks5'),
+            'consumer': None,
         }
         self.sessions[sid] = meta
         self.connections[meta['hash']] = {'sid': sid,
                                           'connection': None,
                                           'callback': callback,
+                                          'pending': 0,
                                           'established_deferred': d}
         return d
 
@@ -240,35 +381,55 @@ class Socks5Stream(protocol.Factory):
             self.unregisterConnection(sid=sid)
         if sid is not None:
             del self.sessions[sid]
+            self.stats.finish(sid)
 
     @defer.inlineCallbacks
     def populate_proxies(self, server_jid, from_=None):
+        """
+        Discover socks5 proxies of the server. Disco info of server items
+        and then streamhosts of found proxies are queried concurrently.
+
+        :returns: deferred firing with list of found proxies ordered by
+        response time.
+        """
         assert self.disco
         if from_ is None:
             from_ = self.dispatcher.myjid
-        result = yield self.disco.getItems(server_jid, from_=from_)
-        proxies = []
-        for item in result.items:
-            try:
-                info = yield self.disco.getInfo(item.jid, from_=from_)
-            except errors.ExceptionWithType:
-                continue
-            if filter(lambda i: i.var == SOCKS5_NS, info.features):
-                proxies.append(item.jid)
-        for jid in proxies:
+        result = yield self.disco.getItems(server_jid, from_=from_,
+                                           timeout=self.proxy_timeout)
+        semaphore = defer.DeferredSemaphore(self.proxy_concurrency)
+
+        @defer.inlineCallbacks
+        def check(jid):
             try:
-                yield self.examine_proxy(jid, from_)
-            except errors.ExceptionWithType:
+                info = yield semaphore.run(self.disco.getInfo, jid,
+                                           from_=from_,
+                                           timeout=self.proxy_timeout)
+                if filter(lambda i: i.var == SOCKS5_NS, info.features):
+                    yield semaphore.run(self.examine_proxy, jid, from_)
+            except (errors.ExceptionWithType, defer.TimeoutError):
                 pass
 
+        yield defer.DeferredList([check(item.jid) for item in result.items])
+        self.proxies = OrderedDict(sorted(self.proxies.items(),
+                       key=lambda p: self.proxy_latencies.get(p[0], 0)))
+        defer.returnValue(self.proxies.keys())
+
     @defer.inlineCallbacks
     def examine_proxy(self, jid, from_):
+        """
+        Query streamhost of the proxy and remember it with response time.
+        """
         query = stanzas.GetStreamHostsQuery(
                  parent=Iq(from_=from_, to=jid, type_='get'))
-        result = yield self.dispatcher.send(query)
+        started = self.clock.seconds()
+        result = yield self.dispatcher.send(query,
+                                            timeout=self.proxy_timeout)
         r = result.streamhost
         result = (r.rhost, r.port)
-        self.proxies[query.iq.to] = result
+        jid = query.iq.to
+        self.proxy_latencies[jid] = self.clock.seconds() - started
+        self.proxies[jid] = result
 
     @defer.inlineCallbacks
     def requestStream(self, jid, callback, sid=None, meta=None, from_=None):
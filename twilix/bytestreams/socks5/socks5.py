@@ -112,9 +112,19 @@ class SOCKSv5Client(protocol.Protocol):
             if errorcode:
                 self.transport.loseConnection()
                 return
+            connection = self.factory.host.connections.get(self.addr)
+            if self.factory.deferred.called or connection is None or \
+               connection['connection']:
+                # Another streamhost was chosen already
+                self.transport.loseConnection()
+                return
             self.state = STATE_READY
-            self.factory.host.connections[self.addr]['connection'] = self
+            connection['connection'] = self
             self.factory.deferred.callback(None)
+            # Data which came together with the answer
+            if self.buf:
+                buf, self.buf = self.buf, ''
+                self.factory.host.dataReceived(self.addr, buf)
 
 class SOCKSv5Outgoing(protocol.Protocol):
     def __init__(self, peersock):
@@ -0,0 +1,205 @@
+"""
+Transfer statistics for bytestream sessions.
+
+Every bytestream session gets a TransferStats instance in a StatsRegistry.
+Registry may be queried for active and recently finished sessions and it
+sends signals (with pydispatch) when a session starts, stalls or finishes.
+"""
+from collections import deque
+
+from pydispatch import dispatcher
+from twisted.internet import reactor
+
+class TransferStats(object):
+    """
+    Counters of one bytestream session.
+
+    Attributes:
+        sid -- session id
+
+        kind -- stream type ('ibb' or 'socks5')
+
+        bytes_in, bytes_out -- numbers of received and sent bytes
+
+        blocks_in, blocks_out -- numbers of received and sent blocks
+
+        stalls -- number of pauses longer than registry's stall_threshold
+
+        started, first_byte, last_activity, finished -- timestamps
+
+    """
+    def __init__(self, registry, sid, kind):
+        self.registry = registry
+        self.sid = sid
+        self.kind = kind
+        self.started = self.last_activity = registry.clock.seconds()
+        self.first_byte = None
+        self.finished = None
+        self.bytes_in = self.bytes_out = 0
+        self.blocks_in = self.blocks_out = 0
+        self.stalls = 0
+        self._samples = deque()
+
+    def _update(self, count):
+        now = self.registry.clock.seconds()
+        if self.first_byte is None:
+            self.first_byte = now
+        elif now - self.last_activity > self.registry.stall_threshold:
+            self.stalls += 1
+            dispatcher.send(self.registry.transfer_stalled, self.registry,
+                            stats=self, pause=now - self.last_activity)
+        self.last_activity = now
+        self._samples.append((now, count))
+        self._prune(now)
+
+    def _prune(self, now):
+        border = now - self.registry.rate_window
+        while self._samples and self._samples[0][0] < border:
+            self._samples.popleft()
+
+    def _end(self):
+        if self.finished is not None:
+            return self.finished
+        return self.registry.clock.seconds()
+
+    def received(self, count):
+        """Count received block of count bytes."""
+        self._update(count)
+        self.bytes_in += count
+        self.blocks_in += 1
+
+    def sent(self, count):
+        """Count sent block of count bytes."""
+        self._update(count)
+        self.bytes_out += count
+        self.blocks_out += 1
+
+    @property
+    def ttfb(self):
+        """Time to first byte in seconds or None."""
+        if self.first_byte is not None:
+            return self.first_byte - self.started
+
+    @property
+    def throughput(self):
+        """Current throughput (bytes per second over rate_window)."""
+        self._prune(self._end())
+        return sum(c for _, c in self._samples) / \
+               float(self.registry.rate_window)
+
+    @property
+    def average_throughput(self):
+        """Average throughput since the first byte in bytes per second."""
+        if self.first_byte is None:
+            return 0.0
+        elapsed = self._end() - self.first_byte
+        if not elapsed:
+            return 0.0
+        return (self.bytes_in + self.bytes_out) / elapsed
+
+    def asDict(self):
+        """Return counters as dict (e.g. to export them)."""
+        return {
+            'sid': self.sid,
+            'kind': self.kind,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'blocks_in': self.blocks_in,
+            'blocks_out': self.blocks_out,
+            'stalls': self.stalls,
+            'ttfb': self.ttfb,
+            'throughput': self.throughput,
+            'average_throughput': self.average_throughput,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+class StatsRegistry(object):
+    """
+    Registry of transfer statistics.
+
+    Signals described here:
+
+        transfer_started: fired with stats when a session is registered.
+
+        transfer_stalled: fired with stats and pause length when data
+        comes after a pause longer than stall_threshold.
+
+        transfer_finished: fired with stats when a session is closed.
+
+    :param stall_threshold: pause in seconds counted as a stall.
+
+    :param rate_window: period in seconds to compute current throughput.
+
+    :param keep_finished: number of finished sessions to keep.
+
+    :param clock: reactor to use (for testing).
+    """
+    transfer_started = object()
+    transfer_stalled = object()
+    transfer_finished = object()
+
+    def __init__(self, stall_threshold=5, rate_window=5, keep_finished=100,
+                 clock=None):
+        self.stall_threshold = stall_threshold
+        self.rate_window = rate_window
+        self.clock = clock or reactor
+        self.active = {}
+        self.finished = deque(maxlen=keep_finished)
+
+    def start(self, sid, kind):
+        """
+        Register new session.
+
+        :returns: TransferStats instance.
+        """
+        stats = TransferStats(self, sid, kind)
+        self.active[sid] = stats
+        dispatcher.send(self.transfer_started, self, stats=stats)
+        return stats
+
+    def finish(self, sid):
+        """Mark session as finished."""
+        stats = self.active.pop(sid, None)
+        if stats is not None:
+            stats.finished = self.clock.seconds()
+            self.finished.append(stats)
+            dispatcher.send(self.transfer_finished, self, stats=stats)
+        return stats
+
+    def get(self, sid):
+        """Return stats of active or recently finished session or None."""
+        stats = self.active.get(sid)
+        if stats is None:
+            for s in self.finished:
+                if s.sid == sid:
+                    stats = s
+        return stats
+
+    def getActive(self):
+        """Return list of stats of active sessions."""
+        return self.active.values()
+
+class StatsConsumer(object):
+    """
+    Consumer proxy counting data written to the wrapped consumer.
+    Everything except writes is passed to the consumer as is.
+    """
+    def __init__(self, consumer, stats):
+        self.consumer = consumer
+        self.stats = stats
+
+    def write(self, data):
+        self.stats.sent(len(data))
+        self.consumer.write(data)
+
+    def writeSequence(self, seq):
+        for data in seq:
+            self.stats.sent(len(data))
+        self.consumer.writeSequence(seq)
+
+    def __getattr__(self, name):
+        return getattr(self.consumer, name)
+
+#: registry used by streams if no other is given
+registry = StatsRegistry()
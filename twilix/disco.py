@@ -4,13 +4,20 @@ You can use it to get disco items or info from another jabber entities and to
 represent your own items and feature to others."""
 import hashlib
 import base64
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
 
 from twilix.base.velement import VElement
-from twilix.stanzas import Query, Iq, MyIq
+from twilix.stanzas import Query, Iq, MyIq, Presence
 from twilix.jid import internJID
 from twilix import fields, errors
 
-class CapsElement(VElement): #XXX: invate automatize caps calculation
+CAPS_NODE = 'https://github.com/MaksimVerzakov/twilix'
+XML_LANG = ('http://www.w3.org/XML/1998/namespace', 'lang')
+
+class CapsElement(VElement):
     """
     Extends VElement. 
     Describe node for entity capabilities with fields that corresponds 
@@ -67,6 +74,131 @@ class Feature(VElement):
 
     var = fields.StringAttr('var')
 
+CAPS_HASHES = {
+    'sha-1': hashlib.sha1,
+    'sha-224': hashlib.sha224,
+    'sha-256': hashlib.sha256,
+    'sha-384': hashlib.sha384,
+    'sha-512': hashlib.sha512,
+    'md5': hashlib.md5,
+}
+
+def _formFields(form):
+    """
+    Return FORM_TYPE and sorted list of (var, sorted values) pairs of
+    fields of the data form element.
+    """
+    form_type = None
+    fields_ = []
+    for field in form.elements():
+        if field.name != 'field':
+            continue
+        values = sorted(unicode(v) for v in field.elements() \
+                        if v.name == 'value')
+        var = field.getAttribute('var')
+        if var == 'FORM_TYPE':
+            form_type = values and values[0] or u''
+        elif var is not None:
+            fields_.append((var, values))
+    fields_.sort()
+    return form_type, fields_
+
+def capsHash(info, hash_='sha-1'):
+    """
+    Calculate entity capabilities hash of disco info query.
+    (XEP-0115 verification string with sorted identities, features and
+    extended service discovery forms)
+
+    :param info: DiscoInfoQuery instance.
+
+    :param hash\_: name of hash function (see CAPS_HASHES).
+
+    :returns: hash in base64 format.
+    """
+    identities = []
+    features = []
+    forms = []
+    for el in info.elements():
+        attrs = el.attributes
+        if el.name == 'identity':
+            identities.append((attrs.get('category', u''),
+                               attrs.get('type', u''),
+                               attrs.get(XML_LANG, u''),
+                               attrs.get('name', u'')))
+        elif el.name == 'feature':
+            features.append(attrs.get('var', u''))
+        elif el.name == 'x' and el.uri == 'jabber:x:data':
+            form_type, fields_ = _formFields(el)
+            if form_type is not None:
+                forms.append((form_type, fields_))
+    s = [u'%s/%s/%s/%s<' % i for i in sorted(identities)]
+    s.extend(u'%s<' % f for f in sorted(features))
+    for form_type, fields_ in sorted(forms):
+        s.append(u'%s<' % form_type)
+        for var, values in fields_:
+            s.append(u'%s<' % var)
+            s.extend(u'%s<' % v for v in values)
+    s = u''.join(s).encode('utf-8')
+    return base64.b64encode(CAPS_HASHES[hash_](s).digest())
+
+class ReceivedCapsElement(CapsElement):
+    """
+    CapsElement of received presences. All attributes are optional, so
+    legacy caps (without hash) don't make the presence invalid.
+    """
+    hash_ = fields.StringAttr('hash', required=False)
+    node = fields.StringAttr('node', required=False)
+    ver = fields.StringAttr('ver', required=False)
+
+class CapsPresence(Presence):
+    """
+    Presence-inheritor class for presences with entity capabilities.
+    Remembers caps of the sender to share disco info between entities
+    with the same capabilities. Caps without hash (legacy caps) are
+    remembered too but they are never verified and shared.
+
+    Attributes:
+        caps -- ReceivedCapsElement node
+
+    """
+    caps = fields.ElementNode(ReceivedCapsElement, required=False)
+
+    def anyHandler(self):
+        """Remember or forget caps of the presence sender."""
+        jid = self.from_
+        if jid is None:
+            return
+        caps = self.caps
+        if self.type_ == 'unavailable' or caps is None or \
+           not caps.node or not caps.ver:
+            self.host.entity_caps.remove(jid.full())
+        elif self.type_ == 'available':
+            self.host.entity_caps.set(jid.full(), (caps.node, caps.ver,
+                                                   caps.hash_))
+
+class CapsHook(Presence):
+    """
+    Presence-inheritor class used as a send hook. Attaches own entity
+    capabilities to outgoing available presences sent from our JID.
+    """
+    def availableHandler(self):
+        """Replace caps element of the presence with the cached one."""
+        myjid = unicode(self.host.dispatcher.myjid)
+        if self.from_ is not None and self.from_.full() != myjid:
+            return self
+        caps = self.host.getCapsElement()
+        old = self.getChildElements(CapsElement.elementName,
+                                    CapsElement.elementUri)
+        if len(old) == 1 and old[0] is caps:
+            return self
+        if old:
+            # Children are shared with the presence being sent, so they
+            # are changed in place
+            old = set(id(c) for c in old)
+            self.children[:] = [c for c in self.children if id(c) not in old]
+        self.addChild(caps)
+        return self
+
 class DiscoInfoQuery(Query):
     """
     Extends Query class.
@@ -181,6 +313,58 @@ class NotFoundDiscoInfoQuery(NotFoundQuery, DiscoInfoQuery):
     """
     pass
 
+class DiscoCache(object):
+    """
+    Cache of remote disco results with LRU eviction and expiration.
+
+    :param ttl: seconds to keep a result (None means forever).
+
+    :param size: maximum number of results to keep.
+
+    :param clock: reactor to use (for testing).
+    """
+    def __init__(self, ttl=300, size=1024, clock=None):
+        self.ttl = ttl
+        self.size = size
+        self.clock = clock or reactor
+        self._items = OrderedDict()
+
+    def get(self, key):
+        """Return cached result or None if it's missed or expired."""
+        item = self._items.pop(key, None)
+        if item is None:
+            return
+        expires, value = item
+        if expires is not None and expires <= self.clock.seconds():
+            return
+        self._items[key] = item
+        return value
+
+    def set(self, key, value):
+        """Cache the result."""
+        self._items.pop(key, None)
+        while len(self._items) >= self.size:
+            self._items.popitem(last=False)
+        expires = None
+        if self.ttl is not None:
+            expires = self.clock.seconds() + self.ttl
+        self._items[key] = (expires, value)
+
+    def remove(self, key):
+        """Remove cached result if there is one."""
+        self._items.pop(key, None)
+
+    def invalidate(self, jid=None):
+        """Remove cached results of the jid (or all results)."""
+        if jid is None:
+            self._items.clear()
+            return
+        for key in [k for k in self._items if k[0] == jid]:
+            del self._items[key]
+
+    def __len__(self):
+        return len(self._items)
+
 class Disco(object):
     """Describe interaction dispatcher with service discovery.
 
@@ -191,19 +375,52 @@ class Disco(object):
        For the root node you should use attributes root_info and root_items in
        the same way.
 
+       Call freeze() on a static query to serialize it once for all replies
+       (see MyElement.freeze) and unfreeze it before changing nested
+       elements such as identities in place.
+
        To implement some dynamic nodes you should use handler param for the
        init method where you can pass your own Disco handlers which will
        generate any answers in runtime based on your criterias.
 
-       :param dispatcher: dispatcher instance to use with the service."""
+       Results of getInfo and getItems are cached for cache_ttl seconds by
+       (jid, node, from_) and concurrent requests of the same node share
+       one query. Disco info of entities advertising entity capabilities
+       (XEP-0115) is also cached by caps node and ver, so all entities
+       with the same verified caps hash share one result. Caps of at most
+       cache_size entities are remembered. Cached results are shared
+       between callers and must not be changed.
+
+       :param dispatcher: dispatcher instance to use with the service.
+
+       :param cache_ttl: seconds to keep remote results.
+
+       :param cache_size: maximum number of results in every cache.
 
-    def __init__(self, dispatcher):
+       Own caps hash is calculated once and recalculated only when
+       identities or features are added to or removed from root_info (call
+       invalidateCaps after changing them in place). Outgoing available
+       presences get cached caps element with caps_node.
+
+       :param clock: reactor to use (for testing).
+
+       :param caps_node: caps node of the software."""
+
+    def __init__(self, dispatcher, cache_ttl=300, cache_size=1024,
+                 clock=None, caps_node=CAPS_NODE):
         """
         Initialize class. 
         Set dispatcher and base fields.
 
         """
         self.dispatcher = dispatcher
+        self.info_cache = DiscoCache(cache_ttl, cache_size, clock)
+        self.items_cache = DiscoCache(cache_ttl, cache_size, clock)
+        self.caps_cache = DiscoCache(None, cache_size, clock)
+        self.entity_caps = DiscoCache(None, cache_size, clock)
+        self._pending = {}
+        self.caps_node = caps_node
+        self._caps = None
 
         self.static_info = {'': DiscoInfoQuery()}
         self.static_items = {'': DiscoItemsQuery()}
@@ -226,14 +443,18 @@ class Disco(object):
             self.dispatcher.registerHandler((handler, host))
         self.dispatcher.registerHandler((NotFoundDiscoInfoQuery, self))
         self.dispatcher.registerHandler((NotFoundDiscoItemsQuery, self))
+        self.dispatcher.registerHandler((CapsPresence, self))
+        self.dispatcher.registerHook('send', (CapsHook, self))
 
         features = (
                     Feature(var='http://jabber.org/protocol/disco#items'),
                     Feature(var='http://jabber.org/protocol/disco#info'),
+                    Feature(var=CapsElement.elementUri),
                    )
         self.root_info.addFeatures(features)
 
-    def getItems(self, jid, node=None, from_=None):
+    def getItems(self, jid, node=None, from_=None, use_cache=True,
+                 timeout=None):
         """
         Get disco items from another entity.
         Return deferred object with the result of type DiscoItemsQuery.
@@ -243,20 +464,21 @@ class Disco(object):
         :param node: node name to get items from.
 
         :param from_: set some specific from address. Uses myjid if none given.
+
+        :param use_cache: return cached result if there is one.
+
+        :param timeout: seconds to wait for the reply (see Dispatcher.send).
         
         :returns:
-            query.iq.deferred - deferrer object with result or error.
+            deferred object with result or error. Result may be shared
+            with other callers, don't change it.
             
         """
-        if from_ is None:
-            from_ = self.dispatcher.myjid
-        query = DiscoItemsQuery(host=self, node=node,
-                                parent=Iq(type_='get', to=jid, from_=from_))
-        query.iq.result_class = DiscoItemsQuery
-        self.dispatcher.send(query.iq)
-        return query.iq.deferred
+        return self._request(DiscoItemsQuery, self.items_cache, jid, node,
+                             from_, use_cache, timeout)
 
-    def getInfo(self, jid, node=None, from_=None):
+    def getInfo(self, jid, node=None, from_=None, use_cache=True,
+                timeout=None):
         """
         Get disco info from another entity.
         Return deferred object with the result of type DiscoInfoQuery.
@@ -266,33 +488,86 @@ class Disco(object):
         :param node: node name to get items from.
 
         :param from_: set some specific from address. Uses myjid if none given.
+
+        :param use_cache: return cached result if there is one.
+
+        :param timeout: seconds to wait for the reply (see Dispatcher.send).
         
         :returns:
-            query.iq.deferred - deferrer object with result or error.
+            deferred object with result or error. Result may be shared
+            with other callers, don't change it.
             
         """
+        return self._request(DiscoInfoQuery, self.info_cache, jid, node,
+                             from_, use_cache, timeout)
+
+    def _request(self, query_class, cache, jid, node, from_, use_cache,
+                 timeout):
+        if isinstance(jid, (str, unicode)):
+            jid = internJID(jid)
         if from_ is None:
             from_ = self.dispatcher.myjid
-        query = DiscoInfoQuery(host=self, node=node,
-                               parent=Iq(type_='get', to=jid, from_=from_))
-        query.iq.result_class = DiscoInfoQuery
-        self.dispatcher.send(query.iq)
-        return query.iq.deferred
+        if isinstance(from_, (str, unicode)):
+            from_ = internJID(from_)
+        key = (jid.full(), node, from_.full())
+        caps = None
+        if query_class is DiscoInfoQuery and node is None:
+            caps = self.entity_caps.get(key[0])
+        if use_cache:
+            result = cache.get(key)
+            if result is None and caps is not None:
+                result = self.caps_cache.get(caps[:2])
+            if result is not None:
+                return defer.succeed(result)
+            waiters = self._pending.get((query_class, key))
+            if waiters is not None:
+                d = defer.Deferred()
+                waiters.append(d)
+                return d
+        query = query_class(host=self, node=node,
+                            parent=Iq(type_='get', to=jid, from_=from_))
+        query.iq.result_class = query_class
+        d = query.iq.deferred
+        waiters = self._pending[(query_class, key)] = []
+        d.addBoth(self._gotResult, query_class, cache, key, caps, waiters)
+        self.dispatcher.send(query.iq, timeout=timeout)
+        return d
+
+    def _gotResult(self, result, query_class, cache, key, caps, waiters):
+        if self._pending.get((query_class, key)) is waiters:
+            del self._pending[(query_class, key)]
+        if not isinstance(result, failure.Failure):
+            cache.set(key, result)
+            if caps is not None and self.entity_caps.get(key[0]) == caps:
+                node, ver, hash_ = caps
+                if hash_ in CAPS_HASHES and capsHash(result, hash_) == ver:
+                    self.caps_cache.set((node, ver), result)
+        for d in waiters:
+            d.callback(result)
+        return result
 
     def getCapsHash(self):
         """
-        Calculate and return hash of identities and features in base64 format 
-        based on own identities and features.
+        Return hash of identities and features in base64 format 
+        based on own identities and features. Hash is cached until
+        root_info children are changed.
+        """
+        return self.getCapsElement().ver
+
+    def getCapsElement(self):
+        """
+        Return cached CapsElement describing own identities and features.
+        Element is frozen and shared between presences, don't change it.
         """
-        s = u''
         info = self.root_info
-        for i in info.identities: #XXX: add identities sort
-            s += '%s/%s//%s<' % (i.category, i.type_, i.iname)
-        features = []
-        for f in info.features:
-            features.append(f.var)
-        features.sort()
-        for f in features:
-            s += '%s<' % f
-        s = s.encode('utf-8')
-        return base64.b64encode(hashlib.sha1(s).digest())
+        token = info._childrenToken()
+        if self._caps is None or self._caps[0] is not info or \
+           self._caps[1] != token:
+            caps = CapsElement(hash_='sha-1', node=self.caps_node,
+                               ver=capsHash(info))
+            self._caps = (info, token, caps.freeze())
+        return self._caps[2]
+
+    def invalidateCaps(self):
+        """Drop cached caps (e.g. after changing identities in place)."""
+        self._caps = None
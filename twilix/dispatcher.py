@@ -9,14 +9,58 @@ back if stanza was corrupted or handler for was not found. You may also use
 an anyHandler which used for any stanza type.
 """
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, TimeoutError
 from twilix.stanzas import Iq, Message, Presence, Stanza
 from twilix.jid import internJID
-from twilix.base.myelement import MyElement, EmptyStanza, BreakStanza
+from twilix.base.myelement import EmptyStanza, BreakStanza
 from twilix.base.exceptions import WrongElement, ElementParseError
 from twilix.errors import ExceptionWithContent, InternalServerErrorException
 from twilix import errors
 
+OVERFLOW_REJECT = 'reject'
+OVERFLOW_DROP_OLDEST = 'drop-oldest'
+
+def _handlerRoute(cls):
+    """
+    Return a (top name, child name, child uris, types)-style tuple
+    describing which stanzas the handler class cls could ever match.
+    None means that any value is suitable.
+    """
+    top = cls.topClass()
+    child_name = child_uris = None
+    child = cls
+    while getattr(getattr(child, 'parentClass', None), 'parentClass', None):
+        child = child.parentClass
+    if child is not top and getattr(child, 'isRequired', True):
+        child_name = child.elementName
+        uri = child.elementUri
+        if isinstance(uri, (tuple, list)):
+            child_uris = frozenset(uri)
+        elif uri is not None:
+            child_uris = frozenset((uri,))
+    types = None
+    if getattr(cls, 'anyHandler', None) is None:
+        types = frozenset(name[:-len('Handler')] for name in dir(cls) \
+                          if name.endswith('Handler') and name != 'Handler')
+    return top.elementName, child_name, child_uris, types
+
+def _routeMatches(route, key):
+    """Checks if stanza described by key could be matched by route."""
+    top_name, child_name, child_uris, types = route
+    name, cname, curi, type_ = key
+    if top_name is not None and top_name != name:
+        return False
+    if child_name is not None and child_name != cname:
+        return False
+    if child_uris is not None and curi not in child_uris:
+        return False
+    if types is not None and type_ not in types:
+        return False
+    return True
+
 class Dispatcher(object):
     """
     Main class for input-output controlling.
@@ -29,12 +73,34 @@ class Dispatcher(object):
     
         _handlers -- list of (handler class, host)-style pairs 
                 (see register/unregisterHandler methods)
+
+        _routes -- dict of candidate handlers lists with format :
+
+            key is a (stanza name, first child name, first child uri,
+            stanza type)-style tuple
+
+            value is a list of (handler class, host)-style pairs in order
+            of registration that could handle such stanza
     
         _callbacks -- dict of callbacks with format :
     
             key is an id of stanza that wait callback value
         
             value is a (deffered, resultclass, errorclass)-style tuple
+
+        iq_timeout -- default number of seconds to wait for a reply on
+        set/get IQ (None means to wait forever)
+
+        max_callbacks -- maximum number of IQs waiting for reply (None means
+        unlimited)
+
+        overflow -- what to do when max_callbacks is reached:
+        OVERFLOW_REJECT fails new IQ without sending it, OVERFLOW_DROP_OLDEST
+        fails the oldest waiting IQ. Failed deferreds are errbacked with
+        ResourceConstraintException.
+
+        completed_iqs, timed_out_iqs, overflowed_iqs -- counters of IQs
+        waited for reply (see getCallbackStats method)
     
     Methods :
         
@@ -48,18 +114,93 @@ class Dispatcher(object):
         send -- method realize sending of any stanzas
     
     """
-    def __init__(self, xs, myjid):
+    route_cache_size = 1024
+    stanza_classes = {
+        'iq': Iq,
+        'message': Message,
+        'presence': Presence,
+    }
+
+    def __init__(self, xs, myjid, iq_timeout=None, max_callbacks=None,
+                 overflow=OVERFLOW_REJECT, clock=None):
         """Initializating by values of xmlstream and JID: listen to stanzas of
         any type and hadle it with the dispatch method, set a value to the
         myjid attribute."""
+        assert overflow in (OVERFLOW_REJECT, OVERFLOW_DROP_OLDEST)
         self.xmlstream = xs
         self.xmlstream.addObserver('/message', self.dispatch)
         self.xmlstream.addObserver('/presence', self.dispatch)
         self.xmlstream.addObserver('/iq', self.dispatch)
         self._handlers = []
+        self._routes = {}
+        self._handler_routes = {}
         self._hooks = {}
-        self._callbacks = {}
+        self._callbacks = OrderedDict()
+        self._timeouts = {}
         self.myjid = myjid
+        self.iq_timeout = iq_timeout
+        self.max_callbacks = max_callbacks
+        self.overflow = overflow
+        self.clock = clock or reactor
+        self.completed_iqs = 0
+        self.timed_out_iqs = 0
+        self.overflowed_iqs = 0
+
+    def getCallbackStats(self):
+        """
+        Return dict with numbers of IQs which are waiting for reply (pending),
+        got reply (completed), got no reply in time (timed_out) and were
+        failed because of max_callbacks limit (overflowed).
+        """
+        return {
+            'pending': len(self._callbacks),
+            'completed': self.completed_iqs,
+            'timed_out': self.timed_out_iqs,
+            'overflowed': self.overflowed_iqs,
+        }
+
+    def _addCallback(self, id, deferred, result_class, error_class,
+                     timeout=None):
+        """
+        Store callback for IQ with given id.
+        Return False if callback was rejected because of overflow or
+        because another IQ with the same id is waiting for reply (deferred
+        is errbacked with ConflictException then).
+        """
+        if id in self._callbacks:
+            deferred.errback(errors.ConflictException())
+            return False
+        if self.max_callbacks is not None and \
+           len(self._callbacks) >= self.max_callbacks:
+            self.overflowed_iqs += 1
+            if self.overflow == OVERFLOW_REJECT:
+                deferred.errback(errors.ResourceConstraintException())
+                return False
+            old_id = iter(self._callbacks).next()
+            old_deferred = self._removeCallback(old_id)[0]
+            old_deferred.errback(errors.ResourceConstraintException())
+        self._callbacks[id] = (deferred, result_class, error_class)
+        if timeout is None:
+            timeout = self.iq_timeout
+        if timeout is not None:
+            self._timeouts[id] = self.clock.callLater(timeout,
+                                                      self._timedOut, id)
+        return True
+
+    def _removeCallback(self, id):
+        """Remove callback for IQ with given id and return it if exists."""
+        call = self._timeouts.pop(id, None)
+        if call is not None and call.active():
+            call.cancel()
+        return self._callbacks.pop(id, None)
+
+    def _timedOut(self, id):
+        """Errback IQ with given id which got no reply in time."""
+        self._timeouts.pop(id, None)
+        callback = self._callbacks.pop(id, None)
+        if callback is not None:
+            self.timed_out_iqs += 1
+            callback[0].errback(TimeoutError())
 
     def registerHook(self, hook_name, hook):
         hooks = self._hooks.get(hook_name, [])
@@ -81,19 +222,54 @@ class Dispatcher(object):
         """Registers new pair of any stanza handler class and it's host"""
         if not handler in self._handlers:
             self._handlers.append(handler)
+            self._routes.clear()
             return True
 
     def unregisterHandler(self, handler):
         """Unregisters pair of any stanza handler class and it's host"""
         if handler in self._handlers:
             self._handlers.remove(handler)
+            self._routes.clear()
             return True
 
+    def getHandlers(self, el):
+        """
+        Return list of (handler class, host)-style pairs that could handle
+        the stanza el. Handlers whose top element, first child element or
+        handled types can't suit the stanza are skipped without parsing.
+
+        :param el: parsed stanza (Iq, Message or Presence instance)
+
+        """
+        child = el.firstChildElement()
+        if child is None:
+            key = (el.name, None, None, el.type_)
+        else:
+            key = (el.name, child.name, child.uri, el.type_)
+        handlers = self._routes.get(key)
+        if handlers is None:
+            handlers = []
+            for handler in self._handlers:
+                cls = handler[0]
+                route = self._handler_routes.get(cls)
+                if route is None:
+                    route = self._handler_routes[cls] = _handlerRoute(cls)
+                if _routeMatches(route, key):
+                    handlers.append(handler)
+            if len(self._routes) >= self.route_cache_size:
+                self._routes.clear()
+            self._routes[key] = handlers
+        return handlers
+
     @inlineCallbacks
     def dispatch(self, el):
         """
         This function realize incoming data handling.
         
+        Stanza is wrapped once (without copying) by the class chosen by it's
+        name. Handlers parsed from the wrapped stanza reuse it's already
+        decoded attributes.
+
         There is a handling :
         
         -- returns callback/errorback value for result/error-type stanzas
@@ -104,17 +280,18 @@ class Dispatcher(object):
         
         """
         results = []
-        el = MyElement.makeFromElement(el)
-        for cls in (Iq, Message, Presence):
-            try:
-                el = cls.createFromElement(el, dont_defer=True)
-            except WrongElement:
-                pass
+        cls = self.stanza_classes.get(el.name)
+        if cls is None:
+            returnValue(None)
+        try:
+            el = cls.createFromElement(el, dont_defer=True)
+        except WrongElement:
+            returnValue(None)
 
         if el.type_ in ('result', 'error') and self._callbacks.has_key(el.id):
             # XXX: check sender here
-            id = el.id
-            deferred, result_class, error_class = self._callbacks[id]
+            deferred, result_class, error_class = self._removeCallback(el.id)
+            self.completed_iqs += 1
             if result_class is not None and el.type_ == 'result':
                 try:
                     el = result_class.createFromElement(el, host=None)
@@ -135,10 +312,9 @@ class Dispatcher(object):
                 if exception is None:
                     exception = errors.exception_by_condition(err.error.condition)
                 deferred.errback(exception)
-            del self._callbacks[id]
         else:
             bad_request = False
-            for handler, host in self._handlers:
+            for handler, host in self.getHandlers(el):
                 try:
                     d = handler.createFromElement(el, host=host,
                                                   dont_defer=True,
@@ -183,7 +359,7 @@ class Dispatcher(object):
                                        condition="feature-not-implemented")))
         returnValue(None)
 
-    def send(self, els):
+    def send(self, els, timeout=None):
         """
         This function realize outgoing data handling.
         
@@ -194,6 +370,10 @@ class Dispatcher(object):
         -- send result stanzas
         
         :param els: is an output stanza or stanzas
+
+        :param timeout: seconds to wait for reply on set/get IQs (uses
+        iq_timeout if None given). Deferred is errbacked with
+        twisted.internet.defer.TimeoutError when timeout is reached.
         
         """
         deferred = None
@@ -225,6 +405,8 @@ class Dispatcher(object):
                 error_class = top_el.error_class
                 assert result_class != 'self'
                 assert error_class != 'self'
-                self._callbacks[top_el.id] = (deferred, result_class, error_class)
+                if not self._addCallback(top_el.id, deferred, result_class,
+                                         error_class, timeout):
+                    continue
             self.xmlstream.send(top_el)
         return deferred
@@ -19,7 +19,7 @@ import base64
 
 from twilix.jid import internJID
 from twilix.base.exceptions import ElementParseError
-from twilix.base.myelement import MyElement, EmptyElement
+from twilix.base.myelement import MyElement, EmptyElement, get_child_elements
 from twilix.utils import parse_timestamp
 
 class AttributeProp(object):
@@ -173,7 +173,15 @@ class BooleanAttr(BooleanType, StringAttr):
     pass
 
 class NodeProp(object):
-    """Base class for all node properties."""
+    """
+    Base class for all node properties.
+
+    Decoded value of the node is cached by element only if cacheable is
+    True, i.e. value depends only on found nodes and their state returned
+    by get_state.
+    """
+    cacheable = False
+
     def __init__(self, xmlnode, required=True, listed=False, unique=False,
                        default=None):
         self.xmlnode = xmlnode
@@ -195,10 +203,7 @@ class NodeProp(object):
         :raises:
             ElementParseError       
         """
-        r = filter(lambda el: not isinstance(el, (str, unicode)) and \
-                              (getattr(el, 'name', None) == self.xmlnode or \
-                               self.xmlnode is None),
-                   el.children)
+        r = get_child_elements(el, self.xmlnode)
         if not self.listed and len(r) > 1:
             raise ElementParseError, 'node %s is not list' % self.xmlnode
         if self.listed:
@@ -209,6 +214,13 @@ class NodeProp(object):
     def to_python(self, value):
         return value
 
+    def get_state(self, value):
+        """
+        Return state of nodes found by get_from_el. Cached value of
+        cacheable node is dropped when state changes.
+        """
+        return None
+
     def clean(self, value):
         return value
 
@@ -252,6 +264,8 @@ class DateTimeNode(DateTimeType, StringNode):
 
 class FlagNode(NodeProp):
     """Used for flag nodes, for example, <registered/> from the XEP-100"""
+    cacheable = True
+
     def get_from_el(self, el):
         """
 
@@ -262,9 +276,7 @@ class FlagNode(NodeProp):
             False otherwise.
            
         """
-        els = [e for e in el.children \
-               if getattr(e, 'name', None) == self.xmlnode]
-        if els:
+        if get_child_elements(el, self.xmlnode):
             return True
         return False
 
@@ -319,6 +331,8 @@ class Base64Node(StringNode):
 
 class ElementNode(NodeProp):
     """Used for nodes contain another element."""
+    cacheable = True
+
     def __init__(self, *args, **kwargs):
         if isinstance(args[0], (str, unicode)):     
             args = args[1:]
@@ -340,12 +354,7 @@ class ElementNode(NodeProp):
             element otherwise.
             
         """
-        r = filter(lambda c_el: \
-                    (self.cls.elementName is None or \
-                     getattr(c_el, 'name', None) == self.cls.elementName) and \
-                    (self.cls.elementUri is None or \
-                     getattr(c_el, 'uri', None) == self.cls.elementUri),
-                   el.children)
+        r = get_child_elements(el, self.cls.elementName, self.cls.elementUri)
         # XXX: Too strictly... :(
         #if not self.listed and len(r) > 1:
         #    raise ElementParseError, 'node %s is not list' % \
@@ -361,6 +370,19 @@ class ElementNode(NodeProp):
             return                                 #XXX: EmptyElement()?
         return self.cls.createFromElement(value)
 
+    def get_state(self, value):
+        """
+        Return children lists and attributes of found elements. Decoded
+        elements share children lists with them, so deeper changes are
+        seen by decoded elements themselves.
+        """
+        if value is None:
+            return ()
+        if not self.listed:
+            value = (value,)
+        return tuple((id(c.children), tuple(c.attributes.items())) \
+                     for c in value)
+
     def clean_set(self, value):
         if isinstance(value, dict):
             return self.cls(**value)
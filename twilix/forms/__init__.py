@@ -1,7 +1,7 @@
 import copy
 
 from twilix.base.velement import VElement
-from twilix.base.myelement import MyElement
+from twilix.base.myelement import MyElement, get_child_elements
 from twilix.base.exceptions import ElementParseError
 from twilix import fields as f
 
@@ -25,13 +25,9 @@ class FormField(f.NodeProp):
         return '%s %s FormField' % (self.var, self.field_type.fieldType)
 
     def get_from_el(self, el):
-        r = filter(lambda r: \
-                   not isinstance(r, (str, unicode)) and \
-                   r.attributes.get('var', None) == self.var and \
-                   getattr(r, 'name', None) == self.xmlnode,
-                el.children)
-        if r:
-            return r[0]
+        for r in get_child_elements(el, self.xmlnode):
+            if r.attributes.get('var', None) == self.var:
+                return r
 
     def to_python(self, value):
         if value is None:
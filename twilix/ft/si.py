@@ -1,7 +1,10 @@
+import hashlib
+import mmap
+
 from twisted.internet import defer
 from twisted.protocols.basic import FileSender
 
-from twilix.si import SIProfile, SIRequest, Feature
+from twilix.si import SIProfile, SIRequest, SIResponse, Feature
 from twilix.base.velement import VElement
 from twilix import errors
 from twilix import fields
@@ -14,6 +17,7 @@ class File(VElement):
 
 class Range(VElement):
     elementName = 'range'
+    elementUri = PROFILE_NS
 
     length = fields.IntegerAttr('length', required=False)
     offset = fields.IntegerAttr('offset', required=False)
@@ -26,7 +30,26 @@ class FileRequest(File):
     description = fields.StringNode('desc', required=False)
     range_ = fields.ElementNode(Range, required=False)
 
+class FileResponse(File):
+    range_ = fields.ElementNode(Range, required=False)
+
+class FTSIResponse(SIResponse):
+    file_ = fields.ElementNode(FileResponse, required=False)
+
 class FTSIRequest(SIRequest):
+    """
+    File transfer request. Application's callback returns a file to write
+    received data to or a tuple (file, offset) to receive the file starting
+    from offset (e.g. to resume an interrupted transfer). Offset is used
+    only if sender supports ranged transfers, otherwise the file is
+    rewound and received from the beginning.
+
+    If sender advertised MD5 hash of the file, hash of the received data
+    is computed while receiving and the transfer fails with HashMismatch
+    if it differs (not checked for ranged transfers).
+    """
+    result_class = FTSIResponse
+
     file_ = fields.ElementNode(FileRequest)
 
     @defer.inlineCallbacks
@@ -36,14 +59,117 @@ class FTSIRequest(SIRequest):
         if buf is None:
             # TODO: application specific error
             raise errors.ForbiddenException
+        offset = 0
+        if isinstance(buf, tuple):
+            buf, offset = buf
+            if self.file_.range_ is None:
+                offset = 0
+                buf.seek(0)
+            elif offset:
+                reply.file_ = FileResponse(range_=Range(offset=offset))
         meta.update({
             'buf': buf,
-            'size': self.file_.size,
+            'size': self.file_.size - offset,
+            'offset': offset,
             'bytes_read': 0,
             'deferred': deferred,
         })
+        if self.file_.hash_ and not offset:
+            meta['digest'] = hashlib.md5()
+            meta['hash'] = self.file_.hash_.lower()
+        meta['timeout'].reset()
         defer.returnValue(reply)
 
+class FileReader(object):
+    """ File-like object reading at most length bytes (if length is
+    given) from the file and updating digest with read data. """
+    def __init__(self, buf, length=None, digest=None):
+        self.buf = buf
+        self.left = length
+        self.digest = digest
+
+    def read(self, size=-1):
+        if self.left is not None and (size < 0 or size > self.left):
+            size = self.left
+        data = self.buf.read(size)
+        if self.left is not None:
+            self.left -= len(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        return data
+
+class MmapSender(object):
+    """ Push producer writing slices of a memory-mapped file to a consumer.
+    Slices are block_size of consumer (if it has one, e.g. IBB transport)
+    or CHUNK_SIZE bytes long. """
+    CHUNK_SIZE = 2 ** 16
+
+    def beginFileTransfer(self, mm, start, end, consumer, digest=None,
+                          progress=None):
+        """
+        Write bytes from start to end of the mapped file to consumer.
+
+        :param digest: hash object to update with written data.
+
+        :param progress: callable called with length of every written slice.
+
+        :returns: deferred fired when all data is written.
+        """
+        self.mm = mm
+        self.pos = start
+        self.end = end
+        self.consumer = consumer
+        self.digest = digest
+        self.progress = progress
+        self.chunk_size = getattr(consumer, 'block_size', None) or \
+                          self.CHUNK_SIZE
+        self.paused = False
+        self.producing = False
+        self.deferred = defer.Deferred()
+        consumer.registerProducer(self, True)
+        self.resumeProducing()
+        return self.deferred
+
+    def resumeProducing(self):
+        self.paused = False
+        if self.producing or self.deferred.called:
+            return
+        self.producing = True
+        try:
+            while not self.paused and self.pos < self.end:
+                chunk = self.mm[self.pos:min(self.pos + self.chunk_size,
+                                             self.end)]
+                self.pos += len(chunk)
+                if self.digest is not None:
+                    self.digest.update(chunk)
+                self.consumer.write(chunk)
+                if self.progress is not None:
+                    self.progress(len(chunk))
+        finally:
+            self.producing = False
+        if self.pos >= self.end and not self.deferred.called:
+            self.consumer.unregisterProducer()
+            self.deferred.callback(None)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def stopProducing(self):
+        if not self.deferred.called:
+            self.deferred.errback(
+                Exception("Consumer asked us to stop producing"))
+
+def map_file(buf):
+    """
+    Memory-map the file read-only.
+
+    :returns: mmap object or None if buf isn't a regular non-empty file.
+    """
+    try:
+        return mmap.mmap(buf.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError):
+        return None
+
 class SIFileTransferProfile(SIProfile):
     handlerClass = FTSIRequest
     NS = PROFILE_NS
@@ -54,17 +180,148 @@ class SIFileTransferProfile(SIProfile):
 
     @defer.inlineCallbacks
     def send_file(self, to, buf, filename, size=None,
-                  description=None, date=None, from_=None):
+                  description=None, date=None, from_=None, hash_=None):
+        """
+        Send file to the entity. Ranged transfers are offered: if receiver
+        asks for a range only this part of the file is sent. Regular files
+        are memory-mapped and sent in slices without read calls.
+
+        :param buf: file object positioned at the beginning of the file.
+
+        :param hash_: MD5 hash of the whole file to advertise. It isn't
+        computed here: callers wanting to advertise a hash must compute it
+        before sending.
+
+        :returns: deferred fired with MD5 hex digest of the sent data. It's
+        a digest of the whole file only if receiver didn't ask for a range,
+        otherwise it covers the sent range only.
+        """
         if size is None:
             buf.seek(0, 2)
             size = buf.tell()
             buf.seek(0)
+        mm = map_file(buf)
+        try:
+            digest = yield self._send_file(to, buf, mm, buf.tell(), filename,
+                                           size, description, date, from_,
+                                           hash_)
+        finally:
+            if mm is not None:
+                mm.close()
+        defer.returnValue(digest)
+
+    def send_file_many(self, recipients, buf, filename, size=None,
+                       description=None, date=None, from_=None, hash_=None,
+                       concurrency=10, progress_cb=None):
+        """
+        Send file to many entities. Up to concurrency transfers (including
+        negotiation) run at once and all of them share one memory map of
+        the file (or one copy of the file in memory if it can't be mapped).
+
+        :param recipients: list of JIDs.
+
+        :param progress_cb: callable called with number of bytes sent to
+        all recipients and total number of bytes to send. Total is reduced
+        when a receiver asks for a range or a transfer fails, so it's equal
+        to the sent number when all transfers are finished.
+
+        :returns: deferred fired with dict mapping recipients to MD5 hashes
+        of sent data or to failures.
+        """
+        if size is None:
+            buf.seek(0, 2)
+            size = buf.tell()
+            buf.seek(0)
+        data = map_file(buf)
+        base = buf.tell()
+        if data is None:
+            data = buf.read(size)
+            base = 0
+        total = [size * len(recipients)]
+        sent = [0]
+
+        def report():
+            if progress_cb is not None:
+                progress_cb(sent[0], total[0])
+
+        def send(to):
+            transfer = {'planned': size, 'sent': 0}
+
+            def started(length):
+                total[0] -= transfer['planned'] - length
+                transfer['planned'] = length
+
+            def progress(count):
+                transfer['sent'] += count
+                sent[0] += count
+                report()
+
+            def failed(failure):
+                total[0] -= transfer['planned'] - transfer['sent']
+                transfer['planned'] = transfer['sent']
+                report()
+                return failure
+
+            return semaphore.run(self._send_file, to, None, data, base,
+                                 filename, size, description, date, from_,
+                                 hash_, progress, started).addErrback(failed)
+
+        def store(result, to):
+            results[to] = result
+
+        def done(_):
+            if isinstance(data, mmap.mmap):
+                data.close()
+            return results
+
+        results = {}
+        semaphore = defer.DeferredSemaphore(concurrency)
+        ds = [send(to).addBoth(store, to) for to in recipients]
+        return defer.DeferredList(ds).addCallback(done)
+
+    @defer.inlineCallbacks
+    def _send_file(self, to, buf, data, base, filename, size, description,
+                   date, from_, hash_, progress=None, started=None):
+        """
+        Negotiate the transfer and send the file from data (memory map or
+        string) starting at base or from buf if data is None.
+
+        :param started: callable called with number of bytes to send when
+        the transfer is negotiated.
+        """
         fr = FileRequest(name_=filename,
                          size=size,
                          date=date,
-                         description=description)
+                         description=description,
+                         hash_=hash_,
+                         range_=Range())
         req = FTSIRequest(file_=fr, profile=PROFILE_NS)
-        stream, sid = yield self.si.initiate(req, to, from_)
-        yield FileSender().beginFileTransfer(buf, stream.getTransport(sid))
+        stream, sid, result = yield self.si.negotiate(req, to, from_)
+        range_ = result.file_ and result.file_.range_
+        offset = 0
+        length = None
+        if range_:
+            offset = range_.offset or 0
+            length = range_.length
+            if length is None:
+                length = size - offset
+        digest = hashlib.md5()
+        consumer = stream.getTransport(sid)
+        if data is not None:
+            start = base + offset
+            end = len(data)
+            if length is not None:
+                end = min(end, start + length)
+            if started is not None:
+                started(max(end - start, 0))
+            yield MmapSender().beginFileTransfer(data, start, end, consumer,
+                                                 digest, progress)
+        else:
+            buf.seek(offset, 1)
+            if started is not None:
+                left = max(size - offset, 0)
+                started(left if length is None else min(length, left))
+            reader = FileReader(buf, length, digest)
+            yield FileSender().beginFileTransfer(reader, consumer)
         stream.unregisterSession(sid=sid)
-
+        defer.returnValue(digest.hexdigest())
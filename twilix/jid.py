@@ -1,11 +1,48 @@
 """Module extends the JID class from twisted library."""
 
-import copy
+from collections import OrderedDict
 
 from twisted.words.protocols.jabber.jid import JID, InvalidFormat
 
 class MyJID(JID):
-    """Extends class JID from twisted.words.protocols.jabber.jid."""
+    """
+    Extends class JID from twisted.words.protocols.jabber.jid.
+
+    MyJID is immutable: string forms, hash and bare jid are computed once
+    and the same instance can be shared between stanzas. Use
+    MyJID(tuple=(...)) to get jid with other parts.
+    """
+    def __init__(self, str=None, tuple=None):
+        super(MyJID, self).__init__(str, tuple)
+        d = self.__dict__
+        d['_userhost'] = JID.userhost(self)
+        d['_full'] = JID.full(self)
+        d['_hash'] = hash((self.user, self.host, self.resource))
+        d['_bare'] = None if self.resource else self
+        d['_frozen'] = True
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen'):
+            raise AttributeError, 'MyJID is immutable'
+        super(MyJID, self).__setattr__(name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError, 'MyJID is immutable'
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, MyJID):
+            return self._full == other._full
+        return super(MyJID, self).__eq__(other)
+
     @property
     def is_bare(self):
         """Checks for bare jid (without resourse part)."""
@@ -13,34 +50,40 @@ class MyJID(JID):
 
     def bare(self):
         """Make bare jid from current jid (without resourse part)."""
-        new = copy.copy(self)
-        new.resource = None
-        return new
+        if self._bare is None:
+            self.__dict__['_bare'] = internJID(self._userhost)
+        return self._bare
+    userhostJID = bare
+
+    def userhost(self):
+        """Return bare jid as unicode string."""
+        return self._userhost
+
+    def full(self):
+        """Return jid as unicode string."""
+        return self._full
 
     def __unicode__(self):
         """
         Override unicode converter.
         Return JID in user@server/resourse form.
         """
-        r = self.host
-        if self.user:
-            r = self.user + '@' + r
-        if self.resource:
-            r += '/' + self.resource
-        return r
+        return self._full
 
 #buffer for recent string-to-jid conversations
-__internJIDs = {}
- 
+INTERN_CACHE_SIZE = 4096
+__internJIDs = OrderedDict()
+
 def internJID(jidstring):
     """
-    Creates and returns MyJID-type object from any jidstring 
-    (with bufferization).
+    Creates and returns MyJID-type object from any jidstring
+    (with bufferization). Returned jid is shared, the buffer keeps
+    INTERN_CACHE_SIZE recently used jids.
     """
-    if jidstring in __internJIDs:
-        j = __internJIDs[jidstring]
-    else:
+    j = __internJIDs.pop(jidstring, None)
+    if j is None:
         j = MyJID(jidstring)
-        __internJIDs[jidstring] = j
-    j = copy.copy(j)
+        while len(__internJIDs) >= INTERN_CACHE_SIZE:
+            __internJIDs.popitem(last=False)
+    __internJIDs[jidstring] = j
     return j
@@ -1,28 +1,114 @@
+from twisted.internet import defer, reactor
+
 from twilix.stanzas import Presence, Iq
 from twilix.base.myelement import MyElement
-from twilix.jid import internJID
+from twilix.jid import internJID, MyJID
 
-from .user import UserPresence, UserItemInfo
+from .user import UserPresence, UserItemInfo, RoomOccupants
 from .connect import ConnectPresence
 from .admin import makeAdminQuery
     
 class MultiChat(object):
     """
     Class implements multi chat user extension.
+
+    Occupants of entered rooms are kept in roster dict: keys are room
+    JIDs and values are RoomOccupants instances. Own nicknames are kept
+    in nicks dict.
+
+    Batch methods (enter_rooms, leave_rooms, update_presence) build the
+    presence once and send it's copy to every room. Copies share frozen
+    children, so they are serialized only once. Batch methods send
+    send_burst presences at once and then wait send_interval seconds
+    to respect server rate limits.
+
+    :param send_interval: seconds between bursts of batch presences.
+
+    :param send_burst: number of batch presences sent without delay.
+
+    :param clock: reactor to use (for testing).
     """
     
     #signals
     user_available = object()
     user_unavailable = object()
     
-    def __init__(self, dispatcher):
+    def __init__(self, dispatcher, send_interval=1, send_burst=10,
+                 clock=None):
         """Setup global configuration"""
         self.dispatcher = dispatcher
+        self.send_interval = send_interval
+        self.send_burst = send_burst
+        self.clock = clock or reactor
         
     def init(self):
         """Makes some initialization actions"""
         self.roster = {}
+        self.nicks = {}
         self.dispatcher.registerHandler((UserPresence, self))
+
+    def _makePresence(self, presence, type_=None, connect=True):
+        """
+        Copy presence template once to send it to rooms. Children are
+        frozen so they are serialized only once.
+        """
+        presence = MyElement.makeFromElement(presence)
+        presence = Presence.createFromElement(presence)
+        presence.from_ = self.dispatcher.myjid
+        if type_ is not None:
+            presence.type_ = type_
+        if connect:
+            ConnectPresence(parent=presence)
+        for c in presence.children:
+            if isinstance(c, MyElement):
+                c.freeze()
+        return presence
+
+    def _copyPresence(self, presence, to):
+        """
+        Return copy of presence template addressed to to. Children are
+        shared with the template.
+        """
+        copy = Presence(source=presence)
+        copy.children = list(presence.children)
+        copy.to = to
+        return copy
+
+    def _roomJID(self, room_jid):
+        """Return bare JID of the room from string or JID."""
+        if not isinstance(room_jid, MyJID):
+            room_jid = internJID(room_jid)
+        return room_jid.bare()
+
+    def _receivers(self, rooms):
+        """Return list of (room bare JID, occupant JID) pairs."""
+        receivers = []
+        for room_jid, nickname in rooms:
+            room = self._roomJID(room_jid)
+            receivers.append((room,
+                              MyJID(tuple=(room.user, room.host, nickname))))
+        return receivers
+
+    def _sendPaced(self, presence, receivers):
+        """
+        Send presence to every receiver, send_burst presences at once.
+
+        :returns: deferred fired when all presences are sent.
+        """
+        d = defer.Deferred()
+        receivers = list(receivers)
+        def sendBurst(start):
+            end = len(receivers)
+            if self.send_interval:
+                end = min(end, start + self.send_burst)
+            for to in receivers[start:end]:
+                self.dispatcher.send(self._copyPresence(presence, to))
+            if end < len(receivers):
+                self.clock.callLater(self.send_interval, sendBurst, end)
+            else:
+                d.callback(None)
+        sendBurst(0)
+        return d
         
     def enter_room(self, presence, room_jid, nickname):
         """
@@ -34,23 +120,36 @@ class MultiChat(object):
         :param status: string-type client's status message
         
         """
-        reciever = internJID(room_jid)
+        (room, reciever), = self._receivers([(room_jid, nickname)])
         
-        assert reciever.bare() not in self.roster, 'already in room'
+        assert room not in self.roster, 'already in room'
         
-        reciever.resource = nickname
- 
-        presence = MyElement.makeFromElement(presence)
-        presence = Presence.createFromElement(presence)
- 
+        presence = self._makePresence(presence)
         presence.to = reciever
-        presence.from_ = self.dispatcher.myjid
         
-        msg = ConnectPresence(parent=presence)
+        self.roster[room] = RoomOccupants()
+        self.nicks[room] = nickname
         
-        self.roster[reciever.bare()] = []
+        self.dispatcher.send(presence)
+
+    def enter_rooms(self, presence, rooms):
+        """
+        Enter many rooms with the same presence.
+        Fails if user already in any of rooms.
+
+        :param rooms: list of (room JID, nickname) pairs
+
+        :returns: deferred fired when all presences are sent.
         
-        self.dispatcher.send(msg.parent)
+        """
+        receivers = self._receivers(rooms)
+        for room, reciever in receivers:
+            assert room not in self.roster, 'already in room'
+        for room, reciever in receivers:
+            self.roster[room] = RoomOccupants()
+            self.nicks[room] = reciever.resource
+        return self._sendPaced(self._makePresence(presence),
+                               [r for _, r in receivers])
         
     def leave_room(self, presence, room_jid, nickname):
         """
@@ -61,25 +160,111 @@ class MultiChat(object):
         :param nickname: string-type client's nickname in conference
         
         """
-        reciever = internJID(room_jid)
+        (room, reciever), = self._receivers([(room_jid, nickname)])
         
-        assert reciever.bare() in self.roster, 'not in room'
+        assert room in self.roster, 'not in room'
         
-        reciever.resource = nickname
+        presence = self._makePresence(presence, type_='unavailable')
+        presence.to = reciever
         
-        presence = MyElement.makeFromElement(presence)
-        presence = Presence.createFromElement(presence)
+        self.dispatcher.send(presence)
         
-        presence.to = reciever
-        presence.from_ = self.dispatcher.myjid
-        presence.type_ = 'unavailable'
+        del self.roster[room]
+        self.nicks.pop(room, None)
+
+    def leave_rooms(self, presence, rooms):
+        """
+        Leave many rooms with the same presence.
+        Fails if user not in any of rooms.
+
+        :param rooms: list of (room JID, nickname) pairs
+
+        :returns: deferred fired when all presences are sent.
         
-        msg = ConnectPresence(parent=presence)
+        """
+        receivers = self._receivers(rooms)
+        for room, reciever in receivers:
+            assert room in self.roster, 'not in room'
+        for room, reciever in receivers:
+            del self.roster[room]
+            self.nicks.pop(room, None)
+        return self._sendPaced(self._makePresence(presence,
+                                                  type_='unavailable'),
+                               [r for _, r in receivers])
+
+    def update_presence(self, presence, rooms=None):
+        """
+        Send changed presence (status, show) to entered rooms.
+
+        :param rooms: list of room JIDs (all entered rooms if None given)
+
+        :returns: deferred fired when all presences are sent.
+        
+        """
+        if rooms is None:
+            rooms = self.nicks.keys()
+        receivers = self._receivers((room, self.nicks[self._roomJID(room)])
+                                    for room in rooms)
+        return self._sendPaced(self._makePresence(presence, connect=False),
+                               [r for _, r in receivers])
+        
+    def get_occupants(self, room_jid):
+        """
+        Return presences of all occupants of the room.
+
+        :param room_jid: JID of room-conference
+        
+        """
+        return list(self.roster[self._roomJID(room_jid)])
+
+    def get_occupant(self, room_jid, nick):
+        """
+        Return presence of the room occupant with the nick or None.
+
+        :param room_jid: JID of room-conference
+
+        :param nick: string-type occupant's nickname
+        
+        """
+        return self.roster[self._roomJID(room_jid)].get(nick)
+
+    def get_occupants_by_jid(self, room_jid, jid):
+        """
+        Return presences of the room occupants with the real JID.
+        Any resource matches if bare JID is given.
+
+        :param room_jid: JID of room-conference
+
+        :param jid: real JID of occupant
         
-        self.dispatcher.send(msg.parent)
+        """
+        if isinstance(jid, (str, unicode)):
+            jid = internJID(jid)
+        return self.roster[self._roomJID(room_jid)].getByJid(jid)
+
+    def get_occupants_by_role(self, room_jid, role):
+        """
+        Return presences of the room occupants with the role.
+
+        :param room_jid: JID of room-conference
+
+        :param role: value of occupant's role
         
-        del self.roster[reciever.bare()]
+        """
+        return self.roster[self._roomJID(room_jid)].getByRole(role)
+
+    def get_occupants_by_affiliation(self, room_jid, affiliation):
+        """
+        Return presences of the room occupants with the affiliation.
+
+        :param room_jid: JID of room-conference
+
+        :param affiliation: value of occupant's affiliation
         
+        """
+        return self.roster[self._roomJID(room_jid)].getByAffiliation(
+                                                                affiliation)
+
     def set_affiliation(self, room_jid, jid, affiliation, reason=None):
         """
         Sends query for changing user's affiliation to room jid.
@@ -1,3 +1,5 @@
+from collections import OrderedDict
+
 from pydispatch import dispatcher
 
 from twilix.stanzas import Presence
@@ -34,6 +36,84 @@ class UserItem(VElement):
     
     item = fields.ElementNode(UserItemInfo, required=False)
 
+class RoomOccupants(object):
+    """
+    Occupants of a multi user chat room: UserPresence instances keyed by
+    nickname and indexed by real JID, role and affiliation.
+    Indexes are updated incrementally on every presence.
+    """
+    def __init__(self):
+        self._nicks = OrderedDict()
+        self._jids = {}
+        self._roles = {}
+        self._affiliations = {}
+
+    def __len__(self):
+        return len(self._nicks)
+
+    def __iter__(self):
+        return iter(self._nicks.values())
+
+    def __contains__(self, nick):
+        return nick in self._nicks
+
+    def _indexes(self, presence):
+        """Return (index, key) pairs the occupant presence belongs to."""
+        item = presence.user.item
+        if item is None:
+            return ()
+        indexes = []
+        if item.jid is not None:
+            indexes.append((self._jids, item.jid.userhost()))
+        if item.role is not None:
+            indexes.append((self._roles, item.role))
+        if item.affiliation is not None:
+            indexes.append((self._affiliations, item.affiliation))
+        return indexes
+
+    def add(self, presence):
+        """Add occupant or update presence of the occupant."""
+        nick = presence.from_.resource
+        if nick in self._nicks:
+            self.remove(nick)
+        self._nicks[nick] = presence
+        for index, key in self._indexes(presence):
+            index.setdefault(key, OrderedDict())[nick] = presence
+
+    def remove(self, nick):
+        """Remove occupant and return it's presence (or None)."""
+        presence = self._nicks.pop(nick, None)
+        if presence is not None:
+            for index, key in self._indexes(presence):
+                occupants = index.get(key)
+                if occupants is not None:
+                    occupants.pop(nick, None)
+                    if not occupants:
+                        del index[key]
+        return presence
+
+    def get(self, nick):
+        """Return presence of the occupant with the nick or None."""
+        return self._nicks.get(nick)
+
+    def getByJid(self, jid):
+        """
+        Return presences of occupants with the real JID (any resource
+        if jid is bare).
+        """
+        occupants = self._jids.get(jid.userhost(), {}).values()
+        if jid.resource is not None:
+            occupants = [p for p in occupants if p.user.item.jid == jid]
+        return occupants
+
+    def getByRole(self, role):
+        """Return presences of occupants with the role."""
+        return self._roles.get(role, {}).values()
+
+    def getByAffiliation(self, affiliation):
+        """Return presences of occupants with the affiliation."""
+        return self._affiliations.get(affiliation, {}).values()
+
 class UserPresence(Presence):
     """
     Presence-inheritor class for multi user chat occupant's info.
@@ -54,8 +134,9 @@ class UserPresence(Presence):
     def anyHandler(self):
         """
         Changes list of info about users in chat.
-        There is addition in roster for 'available'-type presences and 
-        deletion from roster for 'unavailable'-type.
+        There is addition (or update) in room occupants for
+        'available'-type presences and deletion from room occupants for
+        'unavailable'-type.
         Also sends 'user_available'/'user_unavailbale' signals for dispatcher 
         (from pydispatch module).
         
@@ -64,14 +145,13 @@ class UserPresence(Presence):
         if self.user is None:
             return
         
-        room_jid = self.from_.bare()
-        if room_jid not in self.host.roster:
+        occupants = self.host.roster.get(self.from_.bare())
+        if occupants is None:
             return
         
-        self.host.roster[room_jid] = filter(lambda el: el.from_.resource != self.from_.resource, self.host.roster[room_jid])
-        
         if self.type_ == 'unavailable':
+            occupants.remove(self.from_.resource)
             dispatcher.send(self.host.user_unavailable, user=self)
         else:
-            self.host.roster[room_jid].append(self)
+            occupants.add(self)
             dispatcher.send(self.host.user_available, user=self)
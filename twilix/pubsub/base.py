@@ -9,6 +9,7 @@ class CreateNodeElement(VElement):
 
 class Item(VElement):
     elementName = 'item'
+    lazyParse = True
 
     id_ = fields.StringAttr('id', required=False)
     publisher = fields.StringAttr('publisher', required=False)
@@ -38,6 +39,7 @@ class Retract(VElement):
 
 class Items(VElement):
     elementName = 'items'
+    lazyParse = True
 
     items = fields.ElementNode(Item, listed=True, required=False)
     node = fields.StringAttr('node')
@@ -95,6 +97,7 @@ class PubsubOwnerQuery(PubsubQuery):
 class Event(VElement):
     elementName = 'event'
     elementUri = 'http://jabber.org/protocol/pubsub#event'
+    lazyParse = True
 
     items = fields.ElementNode(Items, required=False)
 
@@ -5,6 +5,8 @@ Roster handles a contact list, allows to add or remove contacts.
 Also roster handles contacts statuses and sends signals where some event
 happens.
 """
+from collections import OrderedDict
+
 from pydispatch import dispatcher
 
 from twilix.stanzas import Iq, Query, Presence
@@ -12,6 +14,9 @@ from twilix.base.velement import VElement
 
 from twilix import fields, errors
 
+#: stream feature announced by servers supporting roster versioning
+ROSTERVER_FEATURE = ('urn:xmpp:features:rosterver', 'ver')
+
 class RosterItem(VElement):
     """
     Class for xml roster item node. Inheritor of VElement.
@@ -30,6 +35,7 @@ class RosterItem(VElement):
     """
     elementName = 'item'
     elementUri = 'jabber:iq:roster'
+    lazyParse = True
 
     jid = fields.JidAttr('jid')
     subscription = fields.StringAttr('subscription', required=False)
@@ -61,10 +67,14 @@ class RosterQuery(Query):
     Class attributes:
 
         items -- list of RosterItem instances (i.e. list of contacts)
+
+        ver -- string attribute 'ver' with roster version (XEP-0237)
     
     """
     elementUri = 'jabber:iq:roster'
 
+    ver = fields.StringAttr('ver', required=False)
+
     items = fields.ElementNode(RosterItem, listed=True, unique=True,
                                required=False)
 
@@ -90,6 +100,10 @@ class RosterQuery(Query):
         self.iq.from_ = None
         raise errors.NotAcceptableException()
 
+# Server may answer versioned roster request with an empty result when
+# roster wasn't changed since the requested version.
+_VersionedRosterQuery = RosterQuery.redefineProperty('isRequired', False)
+
 class RosterPresence(Presence):
     """
     Class for xml roster presence. Inheritor of Presence.
@@ -183,9 +197,21 @@ class Roster(object): #List of RosterItem
         resource_changed_status: fired when some resource changed it's status
         information.
 
+    Items are stored in a dict keyed by bare JID and indexed by groups, so
+    lookups by JID or group don't scan the whole roster. Assigning the items
+    attribute rebuilds the indexes.
+
+    If a store is given roster versioning (XEP-0237) may be used: stored
+    roster is loaded on init and, if the server announced ROSTERVER_FEATURE
+    (see init), its version is sent with the roster request, so server
+    replies with changes only. Received roster and roster pushes are saved
+    to the store.
+
     :param dispatcher: dispatcher for send/receive stanzas
 
     :param mypresence: set initial presence to mypresence.
+
+    :param store: RosterStore instance to keep roster between sessions.
     """
     roster_got = object()
     roster_item_added = object()
@@ -201,18 +227,54 @@ class Roster(object): #List of RosterItem
     unsubscribe = object()
     unsubscribed = object()
 
-    def __init__(self, dispatcher, mypresence=None):
+    def __init__(self, dispatcher, mypresence=None, store=None):
         """
         Sets some instance attributes
         """
         self.dispatcher = dispatcher
         self.items = []
         self.mypresence = mypresence
-
-    def init(self):
+        self.store = store
+        self.ver = None
+
+    def _get_items(self):
+        """Return list of roster items."""
+        return self._items.values()
+
+    def _set_items(self, items):
+        """Replace all roster items and rebuild indexes."""
+        self._items = OrderedDict()
+        self._groups = OrderedDict()
+        for item in items:
+            self._indexItem(item)
+    items = property(_get_items, _set_items)
+
+    def _indexItem(self, item):
+        """Add item to the JID and groups indexes."""
+        self._items[item.jid.userhost()] = item
+        for group in item.groups or ():
+            self._groups.setdefault(group, OrderedDict())[
+                                                item.jid.userhost()] = item
+
+    def _unindexItem(self, item):
+        """Remove item from the JID and groups indexes."""
+        key = item.jid.userhost()
+        del self._items[key]
+        for group in item.groups or ():
+            users = self._groups.get(group)
+            if users is not None:
+                users.pop(key, None)
+                if not users:
+                    del self._groups[group]
+
+    def init(self, versioning=False):
         """
         Register necessary handlers to handle roster queries, send a query
         to receive a roster.
+
+        :param versioning: True if server announced ROSTERVER_FEATURE in
+        stream features (e.g. ROSTERVER_FEATURE in xmlstream.features).
+        Stored roster version is sent only in this case.
         """
         self.dispatcher.registerHandler((RosterQuery, self))
         self.dispatcher.registerHandler((RosterPresence, self))
@@ -221,6 +283,12 @@ class Roster(object): #List of RosterItem
         iq = Iq(type_='get')
         query = RosterQuery(parent=iq)
         iq.result_class = RosterQuery
+        if self.store is not None:
+            self.ver, items = self.store.load()
+            self.items = [RosterItem.createFromElement(i) for i in items]
+            if versioning:
+                query.ver = self.ver or ''
+                iq.result_class = _VersionedRosterQuery
         iq.deferred.addCallback(self.gotRoster)
         self.dispatcher.send(iq)
     
@@ -248,12 +316,17 @@ class Roster(object): #List of RosterItem
     def gotRoster(self, query):
         """
         Saves roster items from query instance and send 
-        roster_got signal to dispatcher (from pydispatch module)
+        roster_got signal to dispatcher (from pydispatch module).
+        Stored roster is kept if query is empty.
         
         :param query: instance with roster items
         
         """
-        self.items = list(query.items)
+        if query:
+            self.items = list(query.items)
+            self.ver = getattr(query, 'ver', None)
+            if self.store is not None:
+                self.store.save(self.ver, self.items)
         dispatcher.send(self.roster_got, self)
 
     def addItem(self, item):
@@ -280,21 +353,21 @@ class Roster(object): #List of RosterItem
         self.dispatcher.send(query.iq)
 
     def updateRoster(self, query):
-        """Update items in roster as in query."""
+        """Update items in roster as in query and in the store."""
         for i in query.items:
             if i.subscription == 'remove':
                 self._removeItem(i)
             else:
                 self._addItem(i)
+        ver = getattr(query, 'ver', None)
+        if ver is not None:
+            self.ver = ver
+        if self.store is not None:
+            self.store.update(ver, query.items)
 
     def getItemByJid(self, jid):
         """Find item with same bare jid and return it."""
-        r = None
-        jid = jid.bare()
-        for i in self.items:
-            if jid == i.jid:
-                r = i
-        return r
+        return self._items.get(jid.userhost())
 
     def _removeItem(self, item):
         """
@@ -303,29 +376,20 @@ class Roster(object): #List of RosterItem
         """
         i = self.getItemByJid(item.jid)
         if i is not None:
-            self.items.remove(i)
+            self._unindexItem(i)
             dispatcher.send(self.roster_item_removed, self, i)
             return True
 
     def _addItem(self, item):
         """Add item."""
         self._removeItem(item)
-        self.items.append(item)
+        self._indexItem(item)
         dispatcher.send(self.roster_item_added, self, item)
 
     def getGroups(self):
         """Return list of groups."""
-        groups = []
-        for i in self.items:
-            for g in i.groups:
-                if g not in groups:
-                    groups.append(g)
-        return groups
+        return self._groups.keys()
 
     def getGroupUsers(self, group):
         """Return list of items in group."""
-        items = []
-        for i in self.items:
-            if group in i.groups:
-                items.append(i)
-        return items
+        return self._groups.get(group, {}).values()
@@ -0,0 +1,126 @@
+"""
+Roster stores keep a contact list between sessions.
+
+Together with roster versioning (XEP-0237) a store allows client to receive
+only roster changes after reconnect instead of the whole roster.
+"""
+import os
+from collections import OrderedDict
+
+from twisted.words.xish import domish
+
+from twilix.jid import MyJID
+
+def parse_element(data):
+    """
+    Parse xml string to domish element.
+
+    :param data: string with one xml element.
+
+    :returns: domish.Element instance.
+
+    """
+    roots = []
+    stream = domish.elementStream()
+    stream.DocumentStartEvent = roots.append
+    stream.ElementEvent = lambda el: roots[0].addChild(el)
+    stream.DocumentEndEvent = lambda: None
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    stream.parse(data)
+    return roots[0]
+
+class RosterStore(object):
+    """
+    Store keeping roster in memory. Base class for persistent stores.
+
+    Items are kept serialized and are parsed on load so loaded items never
+    share state (like presences) with items of a previous session.
+
+    Attributes:
+        ver -- version of the stored roster or None
+
+    """
+    def __init__(self):
+        self.ver = None
+        self._items = OrderedDict()
+
+    def load(self):
+        """
+        Return stored roster.
+
+        :returns: tuple of roster version and list of roster item
+                  elements.
+
+        """
+        return self.ver, [parse_element(i) for i in self._items.values()]
+
+    def save(self, ver, items):
+        """
+        Replace stored roster.
+
+        :param ver: roster version.
+
+        :param items: list of RosterItem instances.
+
+        """
+        self.ver = ver
+        self._items = OrderedDict((i.jid.userhost(), i.toXml())
+                                  for i in items)
+        self.flush()
+
+    def update(self, ver, items):
+        """
+        Apply pushed roster items to stored roster.
+
+        :param ver: roster version after the push or None.
+
+        :param items: list of pushed RosterItem instances.
+
+        """
+        if ver is not None:
+            self.ver = ver
+        for i in items:
+            if i.subscription == 'remove':
+                self._items.pop(i.jid.userhost(), None)
+            else:
+                self._items[i.jid.userhost()] = i.toXml()
+        self.flush()
+
+    def flush(self):
+        """Persist stored roster. Does nothing for memory store."""
+
+class FileRosterStore(RosterStore):
+    """
+    Store keeping roster in a xml file as roster query element.
+
+    :param path: path to the file. Roster is loaded from it if it exists.
+
+    """
+    def __init__(self, path):
+        super(FileRosterStore, self).__init__()
+        self.path = path
+        if os.path.exists(path):
+            f = open(path, 'rb')
+            try:
+                query = parse_element(f.read())
+            finally:
+                f.close()
+            self.ver = query.getAttribute('ver')
+            for el in query.elements():
+                self._items[MyJID(el['jid']).userhost()] = el.toXml()
+
+    def flush(self):
+        """Write roster to a temporary file and move it over the old one."""
+        query = domish.Element(('jabber:iq:roster', 'query'))
+        if self.ver is not None:
+            query['ver'] = self.ver
+        data = query.toXml(closeElement=0) + u''.join(self._items.values()) +\
+               u'</query>'
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'wb')
+        try:
+            f.write(data.encode('utf-8'))
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
@@ -12,7 +12,16 @@ from twilix import errors
 
 class ConnectionAborted(Exception):
     """ Raised when connection was closed unexpectidly by a remote side.
-    Usually, it means that remote side aborted a transfer. """
+    Usually, it means that remote side aborted a transfer.
+
+    :param received: position in the file up to which data was received,
+    transfer may be resumed from it. """
+    def __init__(self, received=0):
+        super(ConnectionAborted, self).__init__(received)
+        self.received = received
+
+class HashMismatch(Exception):
+    """ Raised when digest of received data differs from advertised one. """
 
 class FeatureForm(Form):
     def __init__(self, methods=(), *args, **kwargs):
@@ -118,6 +127,16 @@ class SI(object):
 
     @defer.inlineCallbacks
     def initiate(self, request, to, from_=None):
+        stream, sid, result = yield self.negotiate(request, to, from_)
+        defer.returnValue((stream, sid))
+
+    @defer.inlineCallbacks
+    def negotiate(self, request, to, from_=None):
+        """
+        Initiate a stream as initiate does.
+
+        :returns: stream, sid and the SI response from the target.
+        """
         fform = FeatureForm(methods=self.streams.keys(), type_='form')
         feature = Feature(methods=fform)
         request.feature = feature
@@ -138,7 +157,7 @@ class SI(object):
         stream = self.streams[method]
         yield stream.requestStream(to, lambda _buf, _meta:None, sid,
                                    from_=from_)
-        defer.returnValue((stream, sid))
+        defer.returnValue((stream, sid, result))
 
     def receive(self, method, sid, initiator, meta, timeout=60):
         stream = self.streams[method]
@@ -151,17 +170,24 @@ class SI(object):
         if buf is not None:
             if meta.has_key('buf'):
                 meta['buf'].write(buf)
+            if meta.has_key('digest'):
+                meta['digest'].update(buf)
             if count_size:
                 meta['timeout'].reset()
                 meta['bytes_read'] += len(buf)
                 if meta['size'] <= meta['bytes_read']:
                     meta['timeout'].cancel()
-                    meta['deferred'].callback(meta)
+                    if meta.has_key('digest') and \
+                       meta['digest'].hexdigest() != meta['hash']:
+                        meta['deferred'].errback(HashMismatch())
+                    else:
+                        meta['deferred'].callback(meta)
             if meta.has_key('receive_cb'):
                 meta['receive_cb'](buf, meta)
         elif count_size and meta['bytes_read'] != meta['size']:
-            meta['deferred'].errback(ConnectionAborted)
             meta['timeout'].cancel()
+            received = meta.get('offset', 0) + meta['bytes_read']
+            meta['deferred'].errback(ConnectionAborted(received))
         elif not meta['deferred'].called:
             meta['deferred'].callback(meta)
 
@@ -48,6 +48,8 @@ class Stanza(VElement):
     id = fields.StringAttr('id', required=False)
     lang = fields.StringAttr('xml:lang', required=False)
 
+    lazyParse = True
+
     def __init__(self, *args, **kwargs):
         """
         Makes a superclass intialization and set 
@@ -119,7 +121,7 @@ class Iq(Stanza):
         attribute for set/get - type queries
         
         """
-        if 'id' not in kwargs:
+        if 'id' not in kwargs and 'source' not in kwargs:
             kwargs['id'] = uuid.uuid4()
         super(Iq, self).__init__(**kwargs)
         if not self.type_ in ('result', 'error') and \
@@ -240,7 +242,7 @@ class Presence(Stanza):
         Return type of presence when it's requested. 
         If type is None return 'available'.
         """
-        v = self.__getattr__('type_')
+        v = self._getField('type_')
         if not v:
             return 'available'
         return v
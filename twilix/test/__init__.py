@@ -24,6 +24,7 @@ class dispatcherEmul(object):
     def __init__(self, myjid):
         self.myjid = JID(myjid)
         self._handlers = []
+        self._hooks = {}
         self.data = []
         self.connect = False
     
@@ -31,8 +32,11 @@ class dispatcherEmul(object):
         if not handler in self._handlers:
             self._handlers.append(handler)
             return True
+
+    def registerHook(self, hook_name, hook):
+        self._hooks.setdefault(hook_name, []).append(hook)
     
-    def send(self, data):
+    def send(self, data, timeout=None):
         self.data.append(data)
 
 class hostEmul(object):
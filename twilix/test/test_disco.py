@@ -2,10 +2,14 @@ import unittest
 
 from twisted.words.protocols.jabber.jid import JID
 from twisted.internet.defer import Deferred
+from twisted.internet import task
+from twisted.words.xish.domish import Element
 
 from twilix import disco, errors
-from twilix.stanzas import Iq, Query
+from twilix.stanzas import Iq, Query, Presence
+from twilix.dispatcher import Dispatcher
 from twilix.fields import NodeProp
+from twilix.jid import internJID
 
 from twilix.test import dispatcherEmul, hostEmul
 
@@ -64,9 +68,12 @@ class TestDisco(unittest.TestCase):
         test_list=[(disco.VDiscoInfoQuery, self.disco), 
                    (disco.VDiscoItemsQuery, self.disco),
                    (disco.NotFoundDiscoInfoQuery, self.disco), 
-                   (disco.NotFoundDiscoItemsQuery, self.disco)]
+                   (disco.NotFoundDiscoItemsQuery, self.disco),
+                   (disco.CapsPresence, self.disco)]
         test_list.insert(2, hand[0])
         self.assertEqual(self.disco.dispatcher._handlers, test_list)        
+        self.assertTrue('http://jabber.org/protocol/caps' in
+                        [f.var for f in self.disco.root_info.features])
     
     def test_getItems(self):
         result = self.disco.getItems(self.to)
@@ -85,3 +92,218 @@ class TestDisco(unittest.TestCase):
         self.assertEqual(result.to, JID(self.to))
         self.assertEqual(result.from_, JID('myjid'))
         self.assertTrue(isinstance(result, Iq))
+
+
+class TestDiscoCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.disco = disco.Disco(dispatcherEmul('myjid'), cache_ttl=10,
+                                 cache_size=2, clock=self.clock)
+        self.info = disco.DiscoInfoQuery(
+            identities=[disco.Identity(category='client', type_='pc')],
+            features=[disco.Feature(var='urn:xmpp:ping')])
+        self.results = []
+
+    def getInfo(self, jid, **kwargs):
+        self.disco.getInfo(jid, **kwargs).addCallback(self.results.append)
+
+    def reply(self, result):
+        self.disco.dispatcher.data[-1].deferred.callback(result)
+
+    def test_ttl(self):
+        self.getInfo('somejid')
+        self.getInfo('somejid')
+        self.assertEqual(len(self.disco.dispatcher.data), 1)
+        self.reply(self.info)
+        self.getInfo('somejid')
+        self.assertEqual(len(self.disco.dispatcher.data), 1)
+        self.assertEqual(self.results, [self.info] * 3)
+        self.getInfo('somejid', use_cache=False)
+        self.assertEqual(len(self.disco.dispatcher.data), 2)
+        self.reply(self.info)
+        self.clock.advance(10)
+        self.getInfo('somejid')
+        self.assertEqual(len(self.disco.dispatcher.data), 3)
+
+    def test_lru(self):
+        cache = self.disco.info_cache
+        cache.set(('a', None), 1)
+        cache.set(('b', None), 2)
+        self.assertEqual(cache.get(('a', None)), 1)
+        cache.set(('c', None), 3)
+        self.assertEqual(cache.get(('b', None)), None)
+        self.assertEqual(cache.get(('a', None)), 1)
+        cache.invalidate('a')
+        self.assertEqual(len(cache), 1)
+
+    def test_from(self):
+        self.getInfo('somejid')
+        self.reply(self.info)
+        self.getInfo('somejid', from_='other@server.org/res')
+        self.assertEqual(len(self.disco.dispatcher.data), 2)
+        self.getInfo('somejid', from_=self.disco.dispatcher.myjid)
+        self.assertEqual(len(self.disco.dispatcher.data), 2)
+
+    def test_entityCapsBounded(self):
+        for i in range(3):
+            disco.CapsPresence(from_='user%s@server.org/res' % i,
+                caps=disco.CapsElement(node='http://client', ver='ver',
+                                       hash_='sha-1'),
+                host=self.disco).anyHandler()
+        self.assertEqual(len(self.disco.entity_caps), 2)
+        self.assertEqual(self.disco.entity_caps.get('user0@server.org/res'),
+                         None)
+
+    def test_caps(self):
+        ver = disco.capsHash(self.info)
+        for i in range(2):
+            presence = disco.CapsPresence(
+                from_='user%s@server.org/res' % i, to='myjid',
+                caps=disco.CapsElement(node='http://client', ver=ver,
+                                       hash_='sha-1'),
+                host=self.disco)
+            presence.anyHandler()
+        self.getInfo('user0@server.org/res')
+        self.reply(self.info)
+        self.getInfo('user1@server.org/res')
+        self.assertEqual(len(self.disco.dispatcher.data), 1)
+        self.assertEqual(self.results, [self.info] * 2)
+        disco.CapsPresence(from_='user1@server.org/res', type_='unavailable',
+                           host=self.disco).anyHandler()
+        self.getInfo('user1@server.org/res')
+        self.assertEqual(len(self.disco.dispatcher.data), 2)
+
+    def test_capsMismatch(self):
+        for i in range(2):
+            disco.CapsPresence(from_='user%s@server.org/res' % i,
+                caps=disco.CapsElement(node='http://client', ver='wrong',
+                                       hash_='sha-1'),
+                host=self.disco).anyHandler()
+        self.getInfo('user0@server.org/res')
+        self.reply(self.info)
+        self.getInfo('user1@server.org/res')
+        self.assertEqual(len(self.disco.dispatcher.data), 2)
+
+
+class xmlEmul(object):
+    def __init__(self):
+        self.data = []
+
+    def send(self, data):
+        self.data.append(data)
+
+    def addObserver(self, name, dispatcher):
+        pass
+
+
+class TestCaps(unittest.TestCase):
+
+    features = ('http://jabber.org/protocol/caps',
+                'http://jabber.org/protocol/disco#info',
+                'http://jabber.org/protocol/disco#items',
+                'http://jabber.org/protocol/muc')
+
+    def setUp(self):
+        self.dispatcher = Dispatcher(xmlEmul(), myjid='john@server.org')
+        self.disco = disco.Disco(self.dispatcher, caps_node='http://client')
+        self.disco.init()
+        info = self.disco.root_info
+        info.children = []
+        info.addIdentities(disco.Identity(category='client', type_='pc',
+                                          iname='Exodus 0.9.1'))
+        info.addFeatures([disco.Feature(var=f) for f in self.features])
+
+    def test_capsHash(self):
+        self.assertEqual(self.disco.getCapsHash(),
+                         'QgayPKawpkPSDYmwT/WM94uAlu0=')
+
+    def test_capsHashForms(self):
+        identities = []
+        for lang, name in (('en', u'Psi 0.11'), ('el', u'\u03a8 0.11')):
+            identity = disco.Identity(category='client', type_='pc',
+                                      iname=name)
+            identity.attributes[disco.XML_LANG] = lang
+            identities.append(identity)
+        info = disco.DiscoInfoQuery(identities=identities,
+                  features=[disco.Feature(var=f) for f in self.features])
+        form = Element(('jabber:x:data', 'x'))
+        form['type'] = 'result'
+        for var, values in (('FORM_TYPE', ['urn:xmpp:dataforms:softwareinfo']),
+                            ('ip_version', ['ipv4', 'ipv6']),
+                            ('os', ['Mac']), ('os_version', ['10.5.1']),
+                            ('software', ['Psi']),
+                            ('software_version', ['0.11'])):
+            field = form.addElement('field')
+            field['var'] = var
+            for value in values:
+                field.addElement('value', content=value)
+        info.addChild(form)
+        self.assertEqual(disco.capsHash(info), 'q07IKJEyjvHSyhy//CH0CxmKi8w=')
+
+    def test_cached(self):
+        caps = self.disco.getCapsElement()
+        self.assertTrue(self.disco.getCapsElement() is caps)
+        self.disco.root_info.addFeatures(disco.Feature(var='urn:xmpp:ping'))
+        new_caps = self.disco.getCapsElement()
+        self.assertFalse(new_caps is caps)
+        self.assertNotEqual(new_caps.ver, caps.ver)
+
+    def test_sendHook(self):
+        presence = Presence(status='here')
+        self.dispatcher.send(presence)
+        self.dispatcher.send(presence)
+        self.dispatcher.send(Presence(type_='unavailable'))
+        sent = self.dispatcher.xmlstream.data
+        self.assertTrue(sent[0] is presence)
+        caps = [c for c in presence.children if getattr(c, 'name', None) == 'c']
+        self.assertEqual(len(caps), 1)
+        self.assertEqual(caps[0].ver, 'QgayPKawpkPSDYmwT/WM94uAlu0=')
+        self.assertEqual(caps[0].node, 'http://client')
+        self.assertEqual(len(sent[2].children), 0)
+
+    def test_sendHookReplace(self):
+        stale = disco.CapsElement(hash_='sha-1', node='http://client',
+                                  ver='stale')
+        presence = Presence(status='here')
+        presence.addChild(stale)
+        self.assertEqual(presence.getChildElements('c'), [stale])
+        self.dispatcher.send(presence)
+        caps = presence.getChildElements('c')
+        self.assertEqual(len(caps), 1)
+        self.assertTrue(caps[0] is self.disco.getCapsElement())
+
+    def test_sendHookOtherJID(self):
+        presence = Presence(from_='room@conference.server.org/john')
+        self.dispatcher.send(presence)
+        self.assertEqual(presence.getChildElements('c'), ())
+        presence = Presence(from_='john@server.org')
+        self.dispatcher.send(presence)
+        self.assertEqual(len(presence.getChildElements('c')), 1)
+
+    def test_infoReplyNestedChange(self):
+        query = disco.VDiscoInfoQuery(parent=Iq(type_='get'), host=self.disco)
+        self.assertTrue("name='Exodus 0.9.1'" in query.getHandler().toXml())
+        identity = self.disco.root_info.getChildElements('identity')[0]
+        identity['name'] = u'B'
+        self.disco.invalidateCaps()
+        self.assertTrue("name='B'" in query.getHandler().toXml())
+
+    def test_legacyCaps(self):
+        self.dispatcher.myjid = internJID('john@server.org')
+        el = Element((None, 'presence'))
+        el['from'] = 'bob@server.org/res'
+        el['to'] = 'john@server.org'
+        caps = el.addElement(('http://jabber.org/protocol/caps', 'c'))
+        caps['node'] = 'http://client'
+        caps['ver'] = '1.0'
+        self.dispatcher.dispatch(el)
+        self.assertEqual(self.dispatcher.xmlstream.data, [])
+        self.assertEqual(self.disco.entity_caps.get('bob@server.org/res'),
+                         ('http://client', '1.0', None))
+
+    def test_stringJID(self):
+        self.disco.getInfo('server.org')
+        iq = self.dispatcher.xmlstream.data[-1]
+        self.assertEqual(iq['from'], 'john@server.org')
+        self.assertEqual(iq['to'], 'server.org')
@@ -1,8 +1,15 @@
 import unittest
 
-from twilix.dispatcher import Dispatcher
-from twilix.stanzas import Iq
-from twilix import fields
+from twisted.internet.task import Clock
+from twisted.internet.defer import TimeoutError
+from twisted.words.xish.domish import Element
+
+from twilix.dispatcher import Dispatcher, OVERFLOW_DROP_OLDEST
+from twilix.stanzas import Iq, Presence
+from twilix.version import MyVersionQuery, ClientVersion
+from twilix.disco import VDiscoInfoQuery, Disco
+from twilix.jid import internJID
+from twilix import fields, errors
 from twilix.base.exceptions import WrongElement, ElementParseError
 
 class xmlEmul(object):
@@ -50,6 +57,51 @@ class TestDispatcher(unittest.TestCase):
         l = ['hook1', 'hook2', 'hook3']
         self.assertEqual(self.dispatcher.getHooks('hook_name'), l)
 
+    def test_getHandlers(self):
+        version = ClientVersion(self.dispatcher, 'twilix', '1.0')
+        disco = Disco(self.dispatcher)
+        self.dispatcher.registerHandler((VDiscoInfoQuery, disco))
+        self.dispatcher.registerHandler((MyVersionQuery, version))
+        self.dispatcher.registerHandler((Presence, None))
+
+        iq = Iq(type_='get', to='john@server.org', from_='some@where')
+        iq.addElement(('jabber:iq:version', 'query'))
+        self.assertEqual(self.dispatcher.getHandlers(iq),
+                         [(MyVersionQuery, version)])
+        iq = Iq(type_='set', to='john@server.org', from_='some@where')
+        iq.addElement(('jabber:iq:version', 'query'))
+        self.assertEqual(self.dispatcher.getHandlers(iq),
+                         [(MyVersionQuery, version)])
+        iq = Iq(type_='result', to='john@server.org', from_='some@where')
+        iq.addElement(('jabber:iq:version', 'query'))
+        self.assertEqual(self.dispatcher.getHandlers(iq), [])
+        iq = Iq(type_='get', to='john@server.org', from_='some@where')
+        iq.addElement(('http://jabber.org/protocol/disco#info', 'query'))
+        self.assertEqual(self.dispatcher.getHandlers(iq),
+                         [(VDiscoInfoQuery, disco)])
+        self.assertEqual(self.dispatcher.getHandlers(Presence()), [])
+
+        self.dispatcher.unregisterHandler((MyVersionQuery, version))
+        iq = Iq(type_='get', to='john@server.org', from_='some@where')
+        iq.addElement(('jabber:iq:version', 'query'))
+        self.assertEqual(self.dispatcher.getHandlers(iq), [])
+
+    def test_dispatchRouted(self):
+        self.dispatcher.myjid = internJID('john@server.org')
+        version = ClientVersion(self.dispatcher, 'twilix', '1.0')
+        version.init()
+        el = Element((None, 'iq'))
+        el['type'] = 'get'
+        el['id'] = 'v1'
+        el['to'] = 'john@server.org'
+        el['from'] = 'some@where'
+        el.addElement(('jabber:iq:version', 'query'))
+        self.dispatcher.dispatch(el)
+        result = self.dispatcher.xmlstream.data
+        self.assertEqual(result.type_, 'result')
+        self.assertEqual(result.id, 'v1')
+        self.assertEqual(result.firstChildElement().client_name, 'twilix')
+
     def test_send(self):
         # XXX: implement
         pass
@@ -57,5 +109,64 @@ class TestDispatcher(unittest.TestCase):
     def test_dispatch(self):
         # XXX: implement
         pass
-        
-        
+
+    def _reply(self, iq):
+        el = Element((None, 'iq'))
+        el['type'] = 'result'
+        el['id'] = iq.id
+        self.dispatcher.dispatch(el)
+
+    def test_sendTimeout(self):
+        clock = Clock()
+        self.dispatcher = Dispatcher(xmlEmul(), myjid='john@server.org',
+                                     iq_timeout=10, clock=clock)
+        failures = []
+        results = []
+        iq1 = Iq(type_='get')
+        self.dispatcher.send(iq1).addErrback(failures.append)
+        iq2 = Iq(type_='get')
+        self.dispatcher.send(iq2, timeout=30).addCallback(results.append)
+        clock.advance(11)
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(failures[0].check(TimeoutError))
+        self.assertFalse(failures[0].check(errors.ExceptionWithType))
+        self._reply(iq1)
+        self._reply(iq2)
+        self.assertEqual(len(results), 1)
+        clock.advance(30)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(self.dispatcher.getCallbackStats(),
+                         {'pending': 0, 'completed': 1, 'timed_out': 1,
+                          'overflowed': 0})
+
+    def test_sendDuplicateId(self):
+        results = []
+        failures = []
+        self.dispatcher.send(Iq(type_='get', id='dup')).addCallback(
+                                                          results.append)
+        self.dispatcher.send(Iq(type_='get', id='dup')).addErrback(
+                                                          failures.append)
+        self.assertEqual(len(failures), 1)
+        failures[0].trap(errors.ConflictException)
+        self._reply(Iq(type_='get', id='dup'))
+        self.assertEqual(len(results), 1)
+
+    def test_sendOverflow(self):
+        failures = []
+        self.dispatcher.max_callbacks = 1
+        self.dispatcher.send(Iq(type_='get')).addErrback(failures.append)
+        self.dispatcher.send(Iq(type_='get')).addErrback(failures.append)
+        self.assertEqual(len(failures), 1)
+        failures[0].trap(errors.ResourceConstraintException)
+        self.assertEqual(self.dispatcher.getCallbackStats()['pending'], 1)
+
+        self.dispatcher.overflow = OVERFLOW_DROP_OLDEST
+        iq = Iq(type_='get')
+        self.dispatcher.send(iq).addErrback(failures.append)
+        self.assertEqual(len(failures), 2)
+        failures[1].trap(errors.ResourceConstraintException)
+        self.assertEqual(self.dispatcher._callbacks.keys(), [iq.id])
+        stats = self.dispatcher.getCallbackStats()
+        self.assertEqual(stats['pending'], 1)
+        self.assertEqual(stats['overflowed'], 2)
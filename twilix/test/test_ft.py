@@ -0,0 +1,174 @@
+import hashlib
+from StringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from twilix.ft.si import SIFileTransferProfile, FTSIResponse, FileResponse,\
+                         Range, FileReader, MmapSender
+from twilix.si import SI, ConnectionAborted, HashMismatch, TimeOut
+from twilix.stanzas import Iq
+
+
+class consumerEmul(object):
+    def __init__(self):
+        self.data = []
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        while self.producer is not None:
+            producer.resumeProducing()
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.data.append(data)
+
+
+class streamEmul(object):
+    def __init__(self):
+        self.consumer = consumerEmul()
+
+    def getTransport(self, sid):
+        return self.consumer
+
+    def unregisterSession(self, sid):
+        self.unregistered = sid
+
+
+class siEmul(object):
+    def __init__(self, range_=None):
+        self.stream = streamEmul()
+        self.range_ = range_
+
+    def negotiate(self, request, to, from_=None):
+        self.request = request
+        result = FTSIResponse(parent=Iq(type_='result', id='id'))
+        if self.range_ is not None:
+            result.file_ = FileResponse(range_=self.range_)
+        return defer.succeed((self.stream, 'sid', result))
+
+
+class TestSendFile(unittest.TestCase):
+
+    def send(self, range_, hash_=None, buf=None):
+        si = siEmul(range_)
+        profile = SIFileTransferProfile(si, None)
+        if buf is None:
+            buf = StringIO('0123456789')
+        d = profile.send_file('bob@server.org', buf, 'file.txt', hash_=hash_)
+        data = ''.join(si.stream.consumer.data)
+        self.assertEqual(self.successResultOf(d),
+                         hashlib.md5(data).hexdigest())
+        self.assertTrue(si.request.file_.range_ is not None)
+        self.assertEqual(si.request.file_.hash_, hash_)
+        return data
+
+    def test_whole(self):
+        self.assertEqual(self.send(None), '0123456789')
+        self.assertEqual(self.send(None, hash_=u'abc'), '0123456789')
+
+    def test_range(self):
+        self.assertEqual(self.send(Range(offset=4)), '456789')
+        self.assertEqual(self.send(Range(offset=2, length=3)), '234')
+
+    def test_mmap(self):
+        path = self.mktemp()
+        f = open(path, 'wb')
+        f.write('0123456789')
+        f.close()
+        f = open(path, 'rb')
+        self.addCleanup(f.close)
+        self.assertEqual(self.send(None, buf=f), '0123456789')
+        f.seek(0)
+        self.assertEqual(self.send(Range(offset=2, length=3), buf=f), '234')
+
+    def test_mmapSender(self):
+        consumer = consumerEmul()
+        consumer.block_size = 4
+        d = MmapSender().beginFileTransfer('0123456789', 1, 10, consumer)
+        self.successResultOf(d)
+        self.assertEqual(consumer.data, ['1234', '5678', '9'])
+
+    def test_rangeFile(self):
+        f = FileReader(StringIO('0123456789'), 4)
+        self.assertEqual(f.read(3), '012')
+        self.assertEqual(f.read(), '3')
+        self.assertEqual(f.read(), '')
+
+
+class TestStreamCb(unittest.TestCase):
+
+    def test_aborted(self):
+        deferred = defer.Deferred()
+        meta = {'buf': StringIO(), 'size': 6, 'offset': 4, 'bytes_read': 0,
+                'deferred': deferred, 'timeout': TimeOut(60, None, 'sid')}
+        si = SI(None, ())
+        si.stream_cb('4567', meta)
+        si.stream_cb(None, meta)
+        f = self.failureResultOf(deferred, ConnectionAborted)
+        self.assertEqual(f.value.received, 8)
+        self.assertEqual(meta['buf'].getvalue(), '4567')
+
+    def makeMeta(self, hash_):
+        return {'size': 4, 'bytes_read': 0, 'deferred': defer.Deferred(),
+                'timeout': TimeOut(60, None, 'sid'),
+                'digest': hashlib.md5(), 'hash': hash_}
+
+    def test_hash(self):
+        si = SI(None, ())
+        meta = self.makeMeta(hashlib.md5('0123').hexdigest())
+        si.stream_cb('01', meta)
+        si.stream_cb(memoryview('23'), meta)
+        self.assertEqual(self.successResultOf(meta['deferred']), meta)
+        meta = self.makeMeta(hashlib.md5('0124').hexdigest())
+        si.stream_cb('0123', meta)
+        self.failureResultOf(meta['deferred'], HashMismatch)
+
+
+class multiSIEmul(object):
+    def __init__(self):
+        self.pending = []
+
+    def negotiate(self, request, to, from_=None):
+        d = defer.Deferred()
+        self.pending.append((to, d))
+        return d
+
+
+class TestSendFileMany(unittest.TestCase):
+
+    def test_fanOut(self):
+        si = multiSIEmul()
+        profile = SIFileTransferProfile(si, None)
+        progress = []
+        d = profile.send_file_many(['a@s', 'b@s', 'c@s'],
+                                   StringIO('0123456789'), 'file.txt',
+                                   concurrency=2,
+                                   progress_cb=lambda *a: progress.append(a))
+        self.assertEqual([to for to, _ in si.pending], ['a@s', 'b@s'])
+        streams = []
+        for to, negotiated in si.pending[:]:
+            if to == 'b@s':
+                negotiated.errback(Exception())
+                continue
+            stream = streamEmul()
+            streams.append(stream)
+            negotiated.callback((stream, 'sid',
+                                 FTSIResponse(parent=Iq(type_='result'))))
+        self.assertEqual(si.pending[-1][0], 'c@s')
+        stream = streamEmul()
+        streams.append(stream)
+        si.pending[-1][1].callback((stream, 'sid', FTSIResponse(
+                                    parent=Iq(type_='result'),
+                                    file_=FileResponse(
+                                        range_=Range(offset=6)))))
+        results = self.successResultOf(d)
+        self.assertEqual(results['a@s'], hashlib.md5('0123456789').hexdigest())
+        self.assertEqual(results['c@s'], hashlib.md5('6789').hexdigest())
+        results['b@s'].trap(Exception)
+        self.assertEqual([''.join(s.consumer.data) for s in streams],
+                         ['0123456789', '6789'])
+        self.assertEqual(progress[-1], (14, 14))
@@ -0,0 +1,220 @@
+import os
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from twilix.bytestreams.ibb.base import IbbStream, DataQuery
+from twilix.bytestreams.stats import StatsRegistry
+from twilix.jid import internJID
+from twilix.stanzas import Iq
+from twilix.si import TimeOut
+from twilix import errors
+
+
+class dispatcherEmul(object):
+    def __init__(self, myjid):
+        self.myjid = internJID(myjid)
+        self.data = []
+
+    def send(self, iq):
+        iq.deferred = defer.Deferred()
+        self.data.append(iq)
+        return iq.deferred
+
+
+class producerEmul(object):
+    def __init__(self, transport, chunks):
+        self.transport = transport
+        self.chunks = chunks
+
+    def resumeProducing(self):
+        if self.chunks:
+            self.transport.write(self.chunks.pop(0))
+        else:
+            self.transport.unregisterProducer()
+
+    def stopProducing(self):
+        self.chunks = []
+
+
+class pushProducerEmul(object):
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class TestTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.dispatcher = dispatcherEmul('john@server.org/home')
+        self.stats = StatsRegistry(clock=self.clock)
+        self.stream = IbbStream(self.dispatcher, window=2, stats=self.stats,
+                                clock=self.clock)
+        self.session = self.stream.registerSession('sid',
+                                                   'john@server.org/home',
+                                                   'bob@server.org/work',
+                                                   lambda buf, meta: None,
+                                                   block_size=4)
+        self.session['is_outgoing'] = True
+        self.session['active'] = True
+        self.transport = self.session['transport']
+
+    def test_window(self):
+        self.transport.write('a' * 20)
+        self.assertEqual(len(self.dispatcher.data), 2)
+        self.assertEqual(self.dispatcher.data[0].to,
+                         internJID('bob@server.org/work'))
+        self.assertEqual([iq.firstChildElement()['seq']
+                          for iq in self.dispatcher.data], ['0', '1'])
+        self.dispatcher.data[0].deferred.callback(None)
+        # Window grew: three blocks are in flight now
+        self.assertEqual(self.transport.window, 3)
+        self.assertEqual(len(self.dispatcher.data), 4)
+        self.assertEqual(self.transport.inflight, 3)
+
+    def test_producer(self):
+        producer = producerEmul(self.transport, ['abcd', 'efgh', 'ij'])
+        self.transport.registerProducer(producer, False)
+        self.clock.advance(0)
+        # Window is full, next chunk waits in the buffer
+        self.assertEqual(len(self.dispatcher.data), 2)
+        self.assertEqual(self.transport.buffered, 2)
+        self.dispatcher.data[0].deferred.callback(None)
+        self.clock.advance(0)
+        self.assertEqual(len(self.dispatcher.data), 3)
+
+    def test_highWater(self):
+        self.transport.high_water = 8
+        self.transport.low_water = 4
+        producer = pushProducerEmul()
+        self.transport.registerProducer(producer, True)
+        self.transport.write('abcdefg')
+        self.transport.write('hijklmnopq')
+        self.assertTrue(producer.paused)
+        self.assertEqual(self.transport.buffered, 10)
+        self.dispatcher.data[0].deferred.callback(None)
+        self.assertFalse(producer.paused)
+        self.assertEqual(self.transport.buffered, 2)
+        self.assertEqual([iq.firstChildElement().content
+                          for iq in self.dispatcher.data],
+                         ['YWJjZA==', 'ZWZn', 'aGlqaw==', 'bG1ubw=='])
+
+    def test_closeWhenSent(self):
+        self.transport.write('a' * 12)
+        self.stream.unregisterSession('sid')
+        self.assertTrue('sid' in self.stream.sessions)
+        self.dispatcher.data[0].deferred.callback(None)
+        self.assertEqual(len(self.dispatcher.data), 4)
+        self.assertEqual(self.dispatcher.data[-1].firstChildElement().name,
+                         'close')
+        self.assertFalse('sid' in self.stream.sessions)
+
+    def test_stats(self):
+        self.transport.write('a' * 10)
+        stats = self.stats.get('sid')
+        self.assertEqual((stats.bytes_out, stats.blocks_out), (8, 2))
+        self.stream.unregisterSession('sid')
+        self.dispatcher.data[0].deferred.callback(None)
+        self.assertEqual(stats.bytes_out, 10)
+        self.assertFalse(stats.finished is None)
+        self.assertEqual(self.stats.getActive(), [])
+
+    def test_statsInactive(self):
+        stream = IbbStream(self.dispatcher, stats=self.stats,
+                           clock=self.clock)
+        stream.registerSession('sid2', 'bob@server.org/work',
+                               'john@server.org/home', lambda buf, meta: None,
+                               block_size=4)
+        # Incoming session is not opened in time
+        TimeOut(60, stream, 'sid2').fire()
+        self.assertEqual([s.sid for s in self.stats.getActive()], ['sid'])
+        self.assertFalse(self.stats.get('sid2').finished is None)
+
+    def test_failed(self):
+        self.transport.write('a' * 20)
+        self.dispatcher.data[0].deferred.errback(Exception())
+        self.assertEqual(self.transport.buffered, 0)
+        self.assertEqual(len(self.dispatcher.data), 2)
+
+    def test_failedWhenSent(self):
+        self.transport.write('a' * 20)
+        d = self.transport.whenSent()
+        self.dispatcher.data[0].deferred.errback(Exception())
+        return self.assertFailure(d, Exception)
+
+    def test_pumpWhileResumePending(self):
+        self.transport.interval = 1
+        producer = producerEmul(self.transport, [])
+        self.transport.registerProducer(producer, False)
+        self.transport.write('abcd')
+        # Buffer is empty again, producer is going to be resumed
+        self.transport.write('efgh')
+        self.assertEqual(len(self.dispatcher.data), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.dispatcher.data), 2)
+        self.assertEqual(self.transport.buffered, 0)
+
+
+class TestDataHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = dispatcherEmul('john@server.org/home')
+        self.stream = IbbStream(self.dispatcher)
+        self.received = []
+        self.session = self.stream.registerSession('sid',
+                                           'bob@server.org/work',
+                                           'john@server.org/home',
+                                           self.callback, block_size=8)
+        self.session['active'] = True
+
+    def callback(self, buf, meta):
+        self.received.append(buf)
+
+    def makeQuery(self, seq, *children):
+        dq = DataQuery(seq=seq, sid='sid', host=self.stream,
+                       parent=Iq(type_='set', id='d%s' % seq,
+                                 from_='bob@server.org/work',
+                                 to='john@server.org/home'))
+        dq.children = list(children)
+        return dq
+
+    def test_receive(self):
+        res = self.makeQuery(0, u'YWJj', u'ZA', u'==\n').setHandler()
+        self.assertEqual(res.type_, 'result')
+        self.makeQuery(1, u'ZWZn').setHandler()
+        self.assertEqual(self.received, ['abcd', 'efg'])
+        self.assertEqual(self.session['incoming_seq'], 2)
+
+    def test_receiveView(self):
+        self.session['view'] = True
+        read, write = os.pipe()
+        self.addCleanup(os.close, read)
+        self.addCleanup(os.close, write)
+        self.session['fd'] = write
+        self.makeQuery(0, u'YWJj', u'ZA==').setHandler()
+        self.assertTrue(isinstance(self.received[0], memoryview))
+        self.assertEqual(os.read(read, 10), 'abcd')
+
+    def test_receiveFd(self):
+        read, write = os.pipe()
+        self.addCleanup(os.close, read)
+        self.addCleanup(os.close, write)
+        self.session['fd'] = write
+        self.makeQuery(0, u'YWJj', u'ZA==').setHandler()
+        self.assertEqual(self.received, ['abcd'])
+        self.assertTrue(isinstance(self.received[0], str))
+        self.assertEqual(os.read(read, 10), 'abcd')
+
+    def test_receiveErrors(self):
+        self.assertRaises(errors.BadRequestException,
+                          self.makeQuery(0, u'YWJjZ').setHandler)
+        self.assertRaises(errors.NotAcceptableException,
+                          self.makeQuery(0, u'YWJjZGVmZ2hp').setHandler)
+        self.assertRaises(errors.UnexpectedRequestException,
+                          self.makeQuery(1, u'YWJj').setHandler)
+        self.assertEqual(self.received, [])
@@ -39,3 +39,24 @@ class TestInternJID(unittest.TestCase):
         test_jid = JID(jidstring)
         self.assertEqual(jid.internJID(jidstring), test_jid)
         self.assertEqual(jid.internJID(jidstring), test_jid)
+
+    def test_internShared(self):
+        j = jid.internJID(u'user@host/res')
+        self.assertTrue(jid.internJID(u'user@host/res') is j)
+        self.assertTrue(j.bare() is j.bare())
+        self.assertTrue(j.bare().bare() is j.bare())
+        self.assertRaises(AttributeError, setattr, j, 'resource', u'other')
+        self.assertEqual(j.full(), u'user@host/res')
+
+    def test_internBounded(self):
+        size = jid.INTERN_CACHE_SIZE
+        jid.INTERN_CACHE_SIZE = 2
+        try:
+            first = jid.internJID(u'first@host')
+            jid.internJID(u'second@host')
+            jid.internJID(u'first@host')
+            jid.internJID(u'third@host')
+            self.assertTrue(jid.internJID(u'first@host') is first)
+            self.assertEqual(len(jid.__dict__['__internJIDs']), 2)
+        finally:
+            jid.INTERN_CACHE_SIZE = size
@@ -0,0 +1,111 @@
+import unittest
+
+from twisted.internet import task
+
+from twilix.muc import MultiChat
+from twilix.stanzas import Presence
+from twilix.muc.user import UserPresence, UserItem, UserItemInfo
+from twilix.jid import internJID
+
+from twilix.test import dispatcherEmul
+
+
+class TestOccupants(unittest.TestCase):
+
+    def setUp(self):
+        self.muc = MultiChat(dispatcherEmul('john@server.org/home'))
+        self.muc.init()
+        self.muc.enter_room(UserPresence(), 'room@conf.org', 'john')
+
+    def presence(self, nick, jid=None, role='participant',
+                 affiliation='none', type_=None):
+        item = UserItemInfo(role=role, affiliation=affiliation)
+        if jid is not None:
+            item.jid = internJID(jid)
+        presence = UserPresence(from_='room@conf.org/%s' % nick,
+                                to='john@server.org/home', type_=type_,
+                                user=UserItem(item=item), host=self.muc)
+        presence.anyHandler()
+        return presence
+
+    def test_occupants(self):
+        bob = self.presence('bob', 'bob@server.org/work', role='moderator',
+                            affiliation='owner')
+        amy = self.presence('amy', 'amy@server.org/home')
+        self.presence('amy2', 'amy@server.org/work')
+        self.assertEqual(len(self.muc.get_occupants('room@conf.org')), 3)
+        self.assertTrue(self.muc.get_occupant('room@conf.org', 'bob') is bob)
+        self.assertEqual(self.muc.get_occupant('room@conf.org', 'nobody'),
+                         None)
+        self.assertEqual(len(self.muc.get_occupants_by_jid('room@conf.org',
+                                                  'amy@server.org')), 2)
+        self.assertEqual(self.muc.get_occupants_by_jid('room@conf.org',
+                                                  'amy@server.org/home'),
+                         [amy])
+        self.assertEqual(self.muc.get_occupants_by_role('room@conf.org',
+                                                        'moderator'), [bob])
+        self.assertEqual(self.muc.get_occupants_by_affiliation(
+                                        'room@conf.org', 'none'), [amy]
+                         + self.muc.get_occupants_by_jid('room@conf.org',
+                                                  'amy@server.org/work'))
+
+    def test_update(self):
+        self.presence('bob', 'bob@server.org/work')
+        bob = self.presence('bob', 'bob@server.org/work', role='moderator')
+        self.assertEqual(self.muc.get_occupants('room@conf.org'), [bob])
+        self.assertEqual(self.muc.get_occupants_by_role('room@conf.org',
+                                                        'participant'), [])
+        self.presence('bob', 'bob@server.org/work', type_='unavailable')
+        self.assertEqual(self.muc.get_occupants('room@conf.org'), [])
+        self.assertEqual(self.muc.get_occupants_by_jid('room@conf.org',
+                                                  'bob@server.org'), [])
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.muc = MultiChat(dispatcherEmul('john@server.org/home'),
+                             send_interval=1, send_burst=2, clock=self.clock)
+        self.muc.init()
+        self.rooms = [('room%s@conf.org' % i, 'john') for i in range(3)]
+
+    def sent(self):
+        return [(p.to.full(), p.type_, [c.name for c in p.children])
+                for p in self.muc.dispatcher.data]
+
+    def test_enterRooms(self):
+        d = self.muc.enter_rooms(Presence(status='here'), self.rooms)
+        sent = self.sent()
+        self.assertEqual([to for to, _, _ in sent],
+                         ['room0@conf.org/john', 'room1@conf.org/john'])
+        self.assertEqual(sent[0][2], ['status', 'x'])
+        self.clock.advance(1)
+        self.assertEqual(self.sent()[-1][0], 'room2@conf.org/john')
+        first, second = self.muc.dispatcher.data[:2]
+        self.assertFalse(first is second)
+        self.assertTrue(first.children[1] is second.children[1])
+        self.assertEqual(len(self.muc.roster), 3)
+        self.assertTrue(d.called)
+        self.assertRaises(AssertionError, self.muc.enter_rooms, Presence(),
+                          self.rooms[2:])
+
+    def test_enterRoomsWholeBurst(self):
+        d = self.muc.enter_rooms(Presence(), self.rooms[:2])
+        self.assertEqual(len(self.muc.dispatcher.data), 2)
+        self.assertTrue(d.called)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_updateAndLeave(self):
+        self.muc.send_interval = 0
+        self.muc.enter_rooms(Presence(), self.rooms)
+        self.muc.dispatcher.data = []
+        self.muc.update_presence(Presence(show='away'))
+        self.assertEqual(sorted(self.sent()),
+                         [('room%s@conf.org/john' % i, 'available', ['show'])
+                          for i in range(3)])
+        self.muc.dispatcher.data = []
+        self.muc.leave_rooms(Presence(), self.rooms[:2])
+        self.assertEqual([d[1] for d in self.sent()],
+                         ['unavailable'] * 2)
+        self.assertEqual(self.muc.nicks.keys(), [internJID('room2@conf.org')])
@@ -1,6 +1,10 @@
 import unittest
 
+from twisted.words.xish.domish import Element
+
 from twilix.stanzas import Iq, Query
+from twilix.base.myelement import MyElement
+from twilix import fields
 
 class TestMyElement(unittest.TestCase):
     
@@ -29,4 +33,142 @@ class TestMyElement(unittest.TestCase):
         self.assertEqual(iq.error_class, 'error_query_class')
         self.assertEqual(len(iq.children), 1)
 
+    def testCreateFromElementShared(self):
+        class MyQuery(Query):
+            elementName = 'test-query'
+            elementUri = 'test-uri'
+
+        el = Element((None, 'iq'))
+        el['type'] = 'get'
+        el['to'] = 'some@where/res'
+        el.addElement(('test-uri', 'test-query'))
+        iq = Iq.createFromElement(el, dont_defer=True)
+        self.assertTrue(iq.children is el.children)
+        to = iq.to
+        query = MyQuery.createFromElement(iq)
+        self.assertTrue(query.iq.to is to)
+        iq.to = 'other@where'
+        query = MyQuery.createFromElement(iq)
+        self.assertEqual(unicode(query.iq.to), u'other@where')
+
+    def testCreateFromElementLazy(self):
+        class MyQuery(Query):
+            elementName = 'test-query'
+            elementUri = 'test-uri'
+            lazyParse = True
+
+            values = fields.StringNode('value', listed=True, required=False)
+
+        el = Element((None, 'iq'))
+        el['type'] = 'get'
+        el['custom'] = 'attr'
+        query = el.addElement(('test-uri', 'test-query'))
+        query.addElement('value', content=u'a')
+        query.addElement('value', content=u'b')
+        query = MyQuery.createFromElement(el)
+        self.assertEqual(query.__dict__.get('_parsed'), None)
+        self.assertEqual(query.iq.attributes['custom'], 'attr')
+        self.assertFalse(query.iq.attributes is el.attributes)
+        self.assertFalse(query.iq.hasAttribute('id'))
+        self.assertEqual(query.iq.deferred.called, False)
+        self.assertEqual(query.values, ['a', 'b'])
+        self.assertEqual(len(query.children), 2)
+
+    def testFreeze(self):
+        class MyQuery(Query):
+            elementName = 'test-query'
+            elementUri = 'test-uri'
+
+            values = fields.StringNode('value', listed=True, required=False)
+
+        query = MyQuery(values=['a'])
+        iq = Iq(type_='result', id='1')
+        iq.link(query.freeze())
+        xml = iq.toXml()
+        self.assertEqual(xml, u"<iq type='result' id='1'><test-query "
+                              u"xmlns='test-uri'><value>a</value>"
+                              u"</test-query></iq>")
+        serialized = query.getSerialized()
+        self.assertTrue(query.getSerialized() is serialized)
+        self.assertEqual(iq.toXml(), xml)
+
+        query.addValues('b')
+        self.assertFalse(query.getSerialized() is serialized)
+        self.assertEqual(query.toXml(), u"<test-query xmlns='test-uri'>"
+                         u"<value>a</value><value>b</value></test-query>")
+        query.node = 'node'
+        self.assertTrue("node='node'" in iq.toXml())
+
+        query.unfreeze()
+        self.assertFalse(query.getSerialized() is query.getSerialized())
+
+    def testGetChildElements(self):
+        el = MyElement((None, 'query'))
+        a = el.addElement(('a-uri', 'item'))
+        b = el.addElement(('b-uri', 'item'))
+        el.addContent(u'text')
+        c = el.addElement(('a-uri', 'other'))
+        self.assertEqual(el.getChildElements('item'), [a, b])
+        self.assertEqual(el.getChildElements('item', 'b-uri'), [b])
+        self.assertEqual(el.getChildElements(uri='a-uri'), [a, c])
+        self.assertEqual(el.getChildElements(), [a, b, c])
+        self.assertEqual(el.getChildElements('none'), ())
+
+        d = MyElement(('b-uri', 'item'))
+        el.addChild(d)
+        self.assertEqual(el.getChildElements('item', 'b-uri'), [b, d])
+        el.removeChilds(name='item', uri='b-uri')
+        self.assertEqual(el.getChildElements('item'), [a])
+        el.children = [d]
+        self.assertEqual(el.getChildElements(), [d])
+
+    def testReplaceChildSameLength(self):
+        class MyQuery(Query):
+            elementName = 'test-query'
+            elementUri = 'test-uri'
+
+            value = fields.StringNode('value', required=False)
+
+        query = MyQuery(value=u'a').freeze()
+        self.assertEqual(query.value, u'a')
+        self.assertEqual(len(query.getChildElements('value')), 1)
+        serialized = query.getSerialized()
+        other = MyElement((None, 'other'))
+        query.children[0] = other
+        self.assertEqual(query.getChildElements('value'), ())
+        self.assertEqual(query.getChildElements(), [other])
+        self.assertEqual(query.value, None)
+        self.assertFalse(query.getSerialized() is serialized)
+        self.assertTrue('<other/>' in query.toXml())
+
+    def testInsertChildAtFront(self):
+        class MyQuery(Query):
+            elementName = 'test-query'
+            elementUri = 'test-uri'
+
+            values = fields.StringNode('value', listed=True, required=False)
+
+        query = MyQuery(values=[u'b']).freeze()
+        self.assertEqual(query.values, [u'b'])
+        b = query.getChildElements('value')[0]
+        serialized = query.getSerialized()
+        a = MyElement((None, 'value'))
+        a.addContent(u'a')
+        query.children.insert(0, a)
+        self.assertEqual(query.getChildElements('value'), [a, b])
+        self.assertEqual(query.values, [u'a', u'b'])
+        self.assertFalse(query.getSerialized() is serialized)
+        self.assertEqual(query.toXml(), u"<test-query xmlns='test-uri'>"
+                         u"<value>a</value><value>b</value></test-query>")
+
+    def testSharedChildrenChanged(self):
+        el = Element((None, 'iq'))
+        el['type'] = 'get'
+        el.addElement('item')
+        iq = Iq.createFromElement(el, dont_defer=True)
+        self.assertEqual(len(iq.getChildElements('item')), 1)
+        del el.children[0]
+        self.assertTrue(iq.children is el.children)
+        self.assertEqual(iq.getChildElements('item'), ())
+
     # XXX: more tests here
@@ -2,10 +2,12 @@ import unittest
 from twisted.trial import unittest
 
 from pydispatch import dispatcher
+from pydispatch.errors import DispatcherKeyError
 
 from twisted.internet import reactor
 
 from twilix import roster
+from twilix.roster import store
 from twilix.stanzas import Iq
 from twilix.jid import MyJID
 from twilix.base.velement import VElement
@@ -167,15 +169,31 @@ class TestRoster(unittest.TestCase):
         self.assertEqual(res, items[0:1])
         res = self.rost.getGroupUsers('gs')
         self.assertEqual(res, items[1:2])
-        
+
+    def test_groupsIndexUpdate(self):
+        amy = itemEmul(jid='amy@wine', groups=['1', '4'])
+        self.rost.items = [amy, itemEmul(jid='sup@per', groups=['1'])]
+        new_amy = itemEmul(subscription='both', jid='amy@wine',
+                           groups=['gs'])
+        self.rost.updateRoster(queryEmul([new_amy]))
+        self.assertTrue(self.rost.getItemByJid(MyJID('amy@wine')) is new_amy)
+        self.assertEqual(sorted(self.rost.getGroups()), ['1', 'gs'])
+        self.assertEqual(len(self.rost.getGroupUsers('1')), 1)
+        self.assertEqual(self.rost.getGroupUsers('4'), [])
+        self.rost.updateRoster(queryEmul([itemEmul(subscription='remove',
+                                                   jid='sup@per')]))
+        self.assertEqual(sorted(self.rost.getGroups()), ['gs'])
+
+
 class TestRosterPresence(unittest.TestCase):
     
     def setUp(self):
-        dispatcher.connect(self.got_signal, signal=dispatcher.Any)
         items = [itemEmul('fast@wok'), 
                itemEmul('little@nation', presences={'q':'w', 'r':'t'}), 
                itemEmul('gordon@freeman', presences={'1':'2', '3':'4'})]
         host = hostEmulator(items=items)
+        dispatcher.connect(self.got_signal, signal=dispatcher.Any,
+                           sender=host)
         self.rp = roster.RosterPresence(host=host)      
         self.signal = []
         self.sender = []
@@ -285,3 +303,79 @@ class TestRosterPresence(unittest.TestCase):
         self.rp.from_=MyJID('who@lets.the/dogsout')
         self.rp.errorHandler()          
         self.assertEqual(n, len(self.signal))
+
+class TestRosterVersioning(unittest.TestCase):
+
+    def setUp(self):
+        self.store = store.RosterStore()
+        self.store.save('1', [roster.RosterItem(jid='amy@wine',
+                                                subscription='both')])
+        self.rost = roster.Roster(dispatcherEmul('jid'), store=self.store)
+
+    def tearDown(self):
+        try:
+            dispatcher.disconnect(self.rost._send_initial_presence,
+                                  self.rost.roster_got, sender=self.rost)
+        except DispatcherKeyError: # roster was not initialized
+            pass
+
+    def makeResult(self, ver, items):
+        iq = Iq(type_='result', id='r')
+        roster.RosterQuery(parent=iq, ver=ver,
+                           items=[roster.RosterItem(jid=jid,
+                                                    subscription='both')
+                                  for jid in items])
+        return roster._VersionedRosterQuery.createFromElement(iq)
+
+    def test_init(self):
+        self.rost.init(versioning=True)
+        res = self.rost.dispatcher.data[0]
+        self.assertEqual(res.firstChildElement()['ver'], '1')
+        self.assertEqual([unicode(i.jid) for i in self.rost.items],
+                         [u'amy@wine'])
+
+    def test_initNotSupported(self):
+        self.rost.init()
+        res = self.rost.dispatcher.data[0]
+        self.assertFalse(res.firstChildElement().hasAttribute('ver'))
+        self.assertEqual(res.result_class, roster.RosterQuery)
+
+    def test_gotRosterUnchanged(self):
+        self.rost.init(versioning=True)
+        result = roster._VersionedRosterQuery.createFromElement(
+                                            Iq(type_='result', id='r'))
+        self.rost.gotRoster(result)
+        self.assertTrue(self.rost.getItemByJid(MyJID('amy@wine')) is not None)
+        self.assertEqual(self.rost.ver, '1')
+
+    def test_gotRosterChanged(self):
+        self.rost.init(versioning=True)
+        self.rost.gotRoster(self.makeResult('2', ['sup@per']))
+        self.assertEqual(self.rost.getItemByJid(MyJID('amy@wine')), None)
+        ver, items = self.store.load()
+        self.assertEqual(ver, '2')
+        self.assertEqual([i['jid'] for i in items], ['sup@per'])
+
+    def test_push(self):
+        self.rost.init(versioning=True)
+        query = roster.RosterQuery(ver='3', items=[
+                    roster.RosterItem(jid='amy@wine', subscription='remove'),
+                    roster.RosterItem(jid='sup@per', subscription='to')])
+        self.rost.updateRoster(query)
+        self.assertEqual(self.rost.ver, '3')
+        ver, items = self.store.load()
+        self.assertEqual(ver, '3')
+        self.assertEqual([(i['jid'], i['subscription']) for i in items],
+                         [('sup@per', 'to')])
+
+    def test_fileStore(self):
+        path = self.mktemp()
+        s = store.FileRosterStore(path)
+        self.assertEqual(s.load(), (None, []))
+        s.save('5', [roster.RosterItem(jid='amy@wine', nick=u'\u0410my',
+                                       groups=['friends'])])
+        ver, items = store.FileRosterStore(path).load()
+        self.assertEqual(ver, '5')
+        item = roster.RosterItem.createFromElement(items[0])
+        self.assertEqual(item.nick, u'\u0410my')
+        self.assertEqual(item.groups, ['friends'])
@@ -0,0 +1,200 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from twilix.bytestreams.socks5.base import Socks5Stream
+from twilix.bytestreams.socks5 import SOCKS5_NS
+from twilix.bytestreams.socks5.stanzas import StreamHost, GotStreamHost
+from twilix.bytestreams.stats import StatsRegistry
+from twilix.disco import DiscoInfoQuery, DiscoItemsQuery, DiscoItem, Feature
+from twilix.jid import internJID
+from twilix import errors
+
+
+class TestProbeStreamHosts(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.stream = Socks5Stream(None, max_probes=2, probe_stagger=1,
+                                   clock=self.clock)
+        self.stream.connectStreamHost = self.connectStreamHost
+        self.attempts = []
+        self.streamhosts = [StreamHost(rhost='10.0.0.%s' % i, port=i,
+                                       jid='proxy%s@server.org' % i)
+                            for i in range(1, 5)]
+
+    def connectStreamHost(self, streamhost, addr):
+        d = defer.Deferred()
+        self.attempts.append((streamhost.rhost, d))
+        return d
+
+    def test_firstWins(self):
+        result = self.stream.probeStreamHosts(self.streamhosts, 'addr')
+        self.assertEqual(len(self.attempts), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.attempts), 2)
+        # max_probes candidates are in progress
+        self.clock.advance(1)
+        self.assertEqual(len(self.attempts), 2)
+        self.clock.advance(0.5)
+        self.attempts[1][1].callback(None)
+        self.assertEqual(self.successResultOf(result).rhost, '10.0.0.2')
+        self.assertTrue(self.attempts[0][1].called)
+        self.assertEqual(self.stream.latencies[('10.0.0.2', 2)], 1.5)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(
+            [sh.rhost for sh in
+             self.stream.sortStreamHosts(self.streamhosts)][:1],
+            ['10.0.0.2'])
+
+    def test_failedStartsNext(self):
+        result = self.stream.probeStreamHosts(self.streamhosts, 'addr')
+        self.attempts[0][1].errback(Exception())
+        self.assertEqual(len(self.attempts), 2)
+        for i in range(3):
+            self.attempts[-1][1].errback(Exception())
+        self.failureResultOf(result, errors.ItemNotFoundException)
+        self.assertEqual(
+            [sh.rhost for sh in
+             self.stream.sortStreamHosts(self.streamhosts[:1] +
+                                    [StreamHost(rhost='10.0.0.9', port=9)])],
+            ['10.0.0.9', '10.0.0.1'])
+
+
+class transportEmul(object):
+    paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def loseConnection(self):
+        self.lost = True
+
+    def write(self, data):
+        self.written = data
+
+
+class protocolEmul(object):
+    def __init__(self):
+        self.transport = transportEmul()
+
+
+class TestDataReceived(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = StatsRegistry(clock=task.Clock())
+        self.stream = Socks5Stream(None, stats=self.stats)
+        self.stream.registerSession('sid', 'john@server.org',
+                                    'bob@server.org', self.callback)
+        self.addr = self.stream.sessions['sid']['hash']
+        self.connection = protocolEmul()
+        self.stream.connections[self.addr]['connection'] = self.connection
+        self.received = []
+
+    def callback(self, buf, meta):
+        d = defer.Deferred()
+        self.received.append((buf, d))
+        return d
+
+    def test_pause(self):
+        transport = self.connection.transport
+        self.stream.dataReceived(self.addr, 'abc')
+        self.stream.dataReceived(self.addr, 'def')
+        self.assertTrue(transport.paused)
+        self.received[0][1].callback(None)
+        self.assertTrue(transport.paused)
+        self.received[1][1].callback(None)
+        self.assertFalse(transport.paused)
+
+    def test_consumerFailed(self):
+        self.stream.dataReceived(self.addr, 'abc')
+        self.received[0][1].errback(Exception())
+        self.assertTrue(self.connection.transport.lost)
+        self.assertFalse('sid' in self.stream.sessions)
+
+    def test_stats(self):
+        self.stream.dataReceived(self.addr, 'abc')
+        self.stream.dataSend('sid', 'defgh')
+        self.assertEqual(self.connection.transport.written, 'defgh')
+        stats = self.stats.get('sid')
+        self.assertEqual((stats.bytes_in, stats.bytes_out), (3, 5))
+        self.stream.unregisterSession(sid='sid')
+        self.assertEqual(self.stats.getActive(), [])
+        self.assertTrue(self.stats.get('sid') is stats)
+
+
+class discoEmul(object):
+    def __init__(self):
+        self.items = defer.Deferred()
+        self.info = {}
+        self.timeouts = []
+
+    def getItems(self, jid, from_=None, timeout=None):
+        self.timeouts.append(timeout)
+        return self.items
+
+    def getInfo(self, jid, from_=None, timeout=None):
+        self.timeouts.append(timeout)
+        d = self.info[jid.full()] = defer.Deferred()
+        return d
+
+
+class proxyDispatcherEmul(object):
+    myjid = internJID('john@server.org/home')
+
+    def __init__(self):
+        self.data = {}
+
+    def send(self, query, timeout=None):
+        d = self.data[query.iq.to.full()] = defer.Deferred()
+        return d
+
+
+class TestPopulateProxies(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.dispatcher = proxyDispatcherEmul()
+        self.stream = Socks5Stream(self.dispatcher, proxy_concurrency=2,
+                                   proxy_timeout=5, clock=self.clock)
+        self.stream.disco = discoEmul()
+
+    def info(self, *features):
+        return DiscoInfoQuery(features=[Feature(var=f) for f in features])
+
+    def streamhost(self, rhost):
+        return GotStreamHost(streamhost=StreamHost(rhost=rhost,
+                                                   port=7777))
+
+    def test_populate(self):
+        disco = self.stream.disco
+        result = self.stream.populate_proxies('server.org')
+        disco.items.callback(DiscoItemsQuery(items=[
+            DiscoItem(jid='proxy%s.server.org' % i) for i in range(3)]))
+        # Concurrency is limited
+        self.assertEqual(sorted(disco.info), ['proxy0.server.org',
+                                              'proxy1.server.org'])
+        disco.info['proxy1.server.org'].callback(self.info(SOCKS5_NS))
+        self.assertEqual(len(disco.info), 3)
+        self.assertEqual(self.dispatcher.data, {})
+        self.clock.advance(1)
+        disco.info['proxy2.server.org'].callback(self.info(SOCKS5_NS))
+        self.assertEqual(self.dispatcher.data.keys(), ['proxy1.server.org'])
+        self.clock.advance(1)
+        self.dispatcher.data['proxy1.server.org'].callback(
+            self.streamhost('10.0.0.1'))
+        self.clock.advance(0.5)
+        self.dispatcher.data['proxy2.server.org'].callback(
+            self.streamhost('10.0.0.2'))
+        self.assertNoResult(result)
+        # proxy0 doesn't answer
+        disco.info['proxy0.server.org'].errback(defer.TimeoutError())
+        self.assertEqual(disco.timeouts, [5] * 4)
+        self.assertEqual([j.full() for j in self.successResultOf(result)],
+                         ['proxy2.server.org', 'proxy1.server.org'])
+        self.assertEqual(self.stream.proxies.values(),
+                         [('10.0.0.2', 7777), ('10.0.0.1', 7777)])
+        self.assertEqual(self.stream.proxy_latencies[
+                         internJID('proxy1.server.org')], 1)
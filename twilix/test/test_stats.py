@@ -0,0 +1,67 @@
+from pydispatch import dispatcher
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from twilix.bytestreams.stats import StatsRegistry
+
+
+class TestStatsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.registry = StatsRegistry(stall_threshold=2, rate_window=4,
+                                      keep_finished=1, clock=self.clock)
+        self.events = []
+        for signal in (self.registry.transfer_started,
+                       self.registry.transfer_stalled,
+                       self.registry.transfer_finished):
+            dispatcher.connect(self.handler, signal, sender=self.registry)
+
+    def tearDown(self):
+        for signal in (self.registry.transfer_started,
+                       self.registry.transfer_stalled,
+                       self.registry.transfer_finished):
+            dispatcher.disconnect(self.handler, signal, sender=self.registry)
+
+    def handler(self, signal, stats, **kwargs):
+        self.events.append((signal, stats.sid))
+
+    def test_counters(self):
+        stats = self.registry.start('sid', 'ibb')
+        self.clock.advance(1)
+        stats.received(100)
+        self.clock.advance(1)
+        stats.sent(50)
+        stats.received(150)
+        self.assertEqual(stats.ttfb, 1)
+        self.assertEqual((stats.bytes_in, stats.blocks_in), (250, 2))
+        self.assertEqual((stats.bytes_out, stats.blocks_out), (50, 1))
+        self.assertEqual(stats.throughput, 75)
+        self.assertEqual(stats.average_throughput, 300)
+        self.clock.advance(5)
+        self.assertEqual(stats.throughput, 0)
+        self.assertEqual(stats.stalls, 0)
+        stats.received(10)
+        self.assertEqual(stats.stalls, 1)
+        self.assertEqual(stats.asDict()['bytes_in'], 260)
+
+    def test_registry(self):
+        self.registry.start('sid1', 'ibb')
+        stats = self.registry.start('sid2', 'socks5')
+        self.assertEqual(len(self.registry.getActive()), 2)
+        self.clock.advance(3)
+        stats.received(1)
+        stats.received(1)
+        self.registry.finish('sid1')
+        self.registry.finish('sid2')
+        self.assertEqual(self.registry.getActive(), [])
+        # only keep_finished sessions are kept
+        self.assertTrue(self.registry.get('sid1') is None)
+        self.assertTrue(self.registry.get('sid2') is stats)
+        self.assertEqual(stats.finished, 3)
+        self.assertEqual(self.events,
+                         [(self.registry.transfer_started, 'sid1'),
+                          (self.registry.transfer_started, 'sid2'),
+                          (self.registry.transfer_finished, 'sid1'),
+                          (self.registry.transfer_finished, 'sid2')])
@@ -3,7 +3,7 @@ import unittest
 from twisted.words.protocols.jabber.jid import JID
 from twisted.internet.defer import Deferred
 
-from twilix.vcard import MyVCardQuery, VCard, VCardQuery
+from twilix.vcard import MyVCardQuery, VCard, VCardQuery, Photo
 from twilix.stanzas import Iq
 from twilix import errors
 
@@ -28,6 +28,14 @@ class TestVCardQuery(unittest.TestCase):
         self.assertRaises(errors.ItemNotFoundException, 
                           self.MyVCardQuery.getHandler)
         
+    def test_getHandlerNestedChange(self):
+        photo = Photo(type_='image/png', binval='old')
+        self.vc.photo = photo
+        self.MyVCardQuery.getHandler().toXml()
+        photo.binval = 'new'
+        res = self.MyVCardQuery.getHandler()
+        self.assertTrue('bmV3' in res.toXml())
+
     def test_setHandler(self):
         self.assertRaises(errors.ForbiddenException, 
                           self.MyVCardQuery.setHandler)
@@ -1,6 +1,9 @@
 import unittest
 
-from twilix.stanzas import Iq, Query
+from twilix.stanzas import Iq, Query, Message
+from twilix.base.velement import FieldDescriptor, VElement
+from twilix.base.myelement import MyElement
+from twilix import fields
 
 class TestVElement(unittest.TestCase):
     
@@ -29,4 +32,59 @@ class TestVElement(unittest.TestCase):
         self.assertEqual(iq.error_class, 'error_query_class')
         self.assertEqual(len(iq.children), 1)
 
+    def testFieldDescriptor(self):
+        class MyQuery(Query):
+            elementName = 'test-query'
+            elementUri = 'test-uri'
+
+            jid = fields.JidAttr('jid', required=False)
+            values = fields.StringNode('value', listed=True, required=False)
+
+        self.assertTrue(isinstance(MyQuery.__dict__['jid'], FieldDescriptor))
+        self.assertFalse('node' in MyQuery.__dict__)
+
+        query = MyQuery(jid='user@host/res', values=['a'])
+        jid = query.jid
+        self.assertTrue(query.jid is jid)
+        query.jid = 'user@host/other'
+        self.assertEqual(query.jid.resource, 'other')
+
+        self.assertEqual(query.values, ['a'])
+        query.values = ['b', 'c']
+        self.assertEqual(query.values, ['b', 'c'])
+        query.addValues('d')
+        self.assertEqual(query.values, ['b', 'c', 'd'])
+        query.removeChilds(name='value')
+        self.assertEqual(query.values, [])
+        n = MyElement((None, 'value'))
+        n.addChild(u'e')
+        query.addChild(n)
+        self.assertEqual(query.values, ['e'])
+
+    def testNestedChange(self):
+        m = Message(to='a@b', body='hello')
+        self.assertEqual(m.body, u'hello')
+        b = m.getChildElements('body')[0]
+        b.children[0] = u'changed'
+        self.assertEqual(m.body, u'changed')
+        self.assertTrue('changed' in m.toXml())
+
+        class Item(VElement):
+            elementName = 'item'
+
+            kind = fields.StringAttr('kind')
+
+        class MyQuery(Query):
+            elementName = 'test-query'
+            elementUri = 'test-uri'
+
+            item = fields.ElementNode(Item, required=False)
+
+        item = Item(kind='a')
+        query = MyQuery(parent=Iq(type_='set'), item=item)
+        self.assertEqual(query.item.kind, 'a')
+        self.assertTrue(query.item is query.item)
+        item.kind = 'b'
+        self.assertEqual(query.item.kind, 'b')
+
     # XXX: more tests here
@@ -40,6 +40,19 @@ class TestClientVersion(unittest.TestCase):
         hand.insert(0, (MyVersionQuery, self.CV))
         self.assertEqual(self.CV.dispatcher._handlers, hand)
     
+    def test_getVersionQuery(self):
+        self.CV.client_name = 'name'
+        query = MyVersionQuery(parent=Iq(type_='get'), host=self.CV)
+        first = query.getHandler().children[0]
+        second = query.getHandler().children[0]
+        self.assertFalse(first is second)
+        self.assertTrue(first.children[0] is second.children[0])
+        self.assertTrue('<name>name</name>' in second.toXml())
+        self.CV.client_name = 'other'
+        res = query.getHandler().children[0]
+        self.assertEqual(res.client_name, 'other')
+        self.assertTrue('<name>other</name>' in res.toXml())
+
     def test_getVersion(self):
         to = 'to'
         self.CV.getVersion(jid=to)
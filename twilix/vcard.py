@@ -147,6 +147,8 @@ class VCard(object):
     :param dispatcher: set dispatcher that service should use.
 
     :param myvcard: set vcard which should be served as own (for services).
+    Call myvcard.freeze() to serialize it once for all replies (and
+    unfreeze it before changing nested fields like photo).
     """
     def __init__(self, dispatcher, myvcard=None):
         """Initialize dispatcher, myvcard and list of handlers."""
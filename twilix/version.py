@@ -44,10 +44,14 @@ class MyVersionQuery(VersionQuery):
         Returns iq stanza with version's info.
         """        
         iq = self.iq.makeResult()
-        query = VersionQuery(client_name=self.host.client_name,
-                             client_version=self.host.client_version,
-                             client_os=self.host.client_os,
-                             parent=iq)
+        getVersionQuery = getattr(self.host, 'getVersionQuery', None)
+        if getVersionQuery is not None:
+            query = getVersionQuery()
+        else:
+            query = VersionQuery(client_name=self.host.client_name,
+                                 client_version=self.host.client_version,
+                                 client_os=self.host.client_os)
+        iq.link(query)
         return iq
 
     def setHandler(self):
@@ -83,6 +87,7 @@ class ClientVersion(object):
         self.client_name = client_name
         self.client_version = client_version
         self.client_os = client_os
+        self._version_query = None
 
     def init(self, disco=None, handlers=None):
         """Registers handlers and adds version feature in disco.
@@ -99,6 +104,21 @@ class ClientVersion(object):
         if disco is not None:
             disco.root_info.addFeatures(Feature(var='jabber:iq:version'))
 
+    def getVersionQuery(self):
+        """
+        Return new version query to reply with. Its nodes are built and
+        serialized once and are rebuilt when client_name, client_version
+        or client_os are changed.
+        """
+        info = (self.client_name, self.client_version, self.client_os)
+        if self._version_query is None or self._version_query[0] != info:
+            query = VersionQuery(client_name=info[0], client_version=info[1],
+                                 client_os=info[2])
+            for c in query.children:
+                c.freeze()
+            self._version_query = (info, query)
+        return VersionQuery(source=self._version_query[1])
+
     def getVersion(self, jid, from_=None):
         """
         Makes get version query to some JID.